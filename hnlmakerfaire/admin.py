@@ -0,0 +1,510 @@
+"""Admin views and forms. This blueprint (and with it WTForms and
+WTForms-Alchemy) is only imported by register_admin() on a worker's first
+/admin/ request, so workers that only answer the SMS webhook never load it.
+"""
+from datetime import datetime
+from flask import Blueprint
+from flask import Response
+from flask import abort
+from flask import current_app
+from flask import flash
+from flask import jsonify
+from flask import redirect
+from flask import render_template
+from flask import request
+from flask import stream_with_context
+from flask import url_for
+from flask_wtf import Form
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.sql import and_
+from sqlalchemy.sql import or_
+from wtforms.fields import FormField
+from wtforms.validators import DataRequired
+from wtforms.widgets import TextInput
+from wtforms_alchemy import ModelFieldList
+from wtforms_alchemy import model_form_factory
+from app import Audit
+from app import EXPORTS
+from app import EXPORT_FORMATS
+from app import PhoneNumber
+from app import PhoneNumberRaffleNumber
+from app import RAFFLE_EVENTS_CHANNEL
+from app import RAFFLE_TIME_FORMAT
+from app import RaffleEvent
+from app import RaffleWinner
+from app import RaffleWinnerImportError
+from app import WINNER_COPY
+from app import WinnerMatch
+from app import _enqueue_notification
+from app import bump_raffle_winner_version
+from app import bump_stats
+from app import db_session
+from app import export_rows
+from app import get_hst_time
+from app import get_stats
+from app import get_stats_by_minute
+from app import import_raffle_winners
+from app import outbound_message_sender
+from app import parse_raffle_winners
+from app import requires_auth
+from app import shared_state
+
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+# forms
+BaseModelForm = model_form_factory(Form)
+
+class ModelForm(BaseModelForm):
+    @classmethod
+    def get_session(self):
+        return db_session
+
+
+class RaffleWinnerForm(ModelForm):
+    class Meta:
+        model = RaffleWinner
+        include_primary_key = True
+        only = ['raffle_time', 'raffle_number', 'item']
+        field_args = {'raffle_time': {'widget': TextInput()}}
+
+
+class PhoneNumberRaffleNumberForm(ModelForm):
+    class Meta:
+        model = PhoneNumberRaffleNumber
+        only = ['raffle_number']
+
+
+class PhoneNumberForm(ModelForm):
+    class Meta:
+        model = PhoneNumber
+        include_primary_key = True
+        only = ['phone_number']
+        validators = {'phone_number': DataRequired()}
+
+    raffle_numbers = ModelFieldList(FormField(PhoneNumberRaffleNumberForm), min_entries=1)
+
+
+# admin index
+@admin.route('/', methods=['GET'])
+@requires_auth
+def admin_index():
+    return render_template('admin/index.html')
+
+
+# admin stats
+@admin.route('/stats', methods=['GET'])
+@requires_auth
+def admin_view_stats():
+    stats = get_stats()
+    by_minute = get_stats_by_minute(current_app.config['STATS_DASHBOARD_MINUTES'])
+    if request.args.get('format') == 'json':
+        return jsonify(stats=stats, by_minute=[
+            dict(values, minute=minute.strftime(RAFFLE_TIME_FORMAT))
+            for minute, values in by_minute])
+    return render_template('admin/stats.html', stats=stats,
+                           by_minute=by_minute)
+
+
+# admin view_raffle_winners
+@admin.route('/raffle_winners/', methods=['GET'])
+@requires_auth
+def admin_view_raffle_winners():
+    raffle_winners = RaffleWinner.\
+        query.all()
+    return render_template('admin/raffle_winners/view_raffle_winners.html',
+                           raffle_winners=raffle_winners)
+
+
+# admin add_raffle_winner
+@admin.route('/raffle_winners/add', methods=['GET', 'POST'])
+@requires_auth
+def admin_add_raffle_winner():
+    form = RaffleWinnerForm()
+    if request.method == 'GET':
+        form.raffle_time.data = get_hst_time()
+    else:
+        if form.validate_on_submit():
+            raffle_winner = RaffleWinner()
+            form.populate_obj(raffle_winner)
+            raffle_winner.is_claimed = False
+            raffle_winner.updated_at = datetime.utcnow()
+            raffle_winner.created_at = datetime.utcnow()
+
+            audit = Audit("Admin has drawn number {0} for prize {1}".format(raffle_winner.raffle_number, raffle_winner.item),
+                          raffle_number=raffle_winner.raffle_number)
+
+            db_session.add(audit)
+            db_session.add(raffle_winner)
+            db_session.add(RaffleEvent('winner_added',
+                                       raffle_winner.raffle_number,
+                                       raffle_winner.item))
+            bump_stats(winners=1)
+            bump_raffle_winner_version()
+            db_session.commit()
+            shared_state.publish(RAFFLE_EVENTS_CHANNEL)
+            return redirect(url_for('.admin_view_raffle_winners'))
+
+    return render_template('admin/raffle_winners/add_raffle_winner.html', form=form)
+
+
+# admin import_raffle_winners
+@admin.route('/raffle_winners/import', methods=['GET', 'POST'])
+@requires_auth
+def admin_import_raffle_winners():
+    errors = []
+    matches = None
+    json_rows = request.get_json(silent=True)
+    if request.method == 'POST':
+        try:
+            if json_rows is not None:
+                rows = json_rows
+            else:
+                upload = request.files.get('winners_file', None)
+                try:
+                    text = upload.read().decode('utf-8') if upload else \
+                        request.values.get('winners', u'')
+                except UnicodeDecodeError as e:
+                    raise RaffleWinnerImportError([
+                        'The uploaded file is not UTF-8: {0}'.format(e)])
+                rows = parse_raffle_winners(text)
+            matches = import_raffle_winners(rows)
+        except RaffleWinnerImportError as e:
+            errors = e.errors
+
+        if json_rows is not None:
+            return jsonify(errors=errors, matches=[
+                {'phone_number': match.phone_number,
+                 'raffle_number': match.raffle_number}
+                for match in matches or []]), 400 if errors else 200
+
+    return render_template('admin/raffle_winners/import_raffle_winners.html',
+                           errors=errors, matches=matches)
+
+
+# admin edit_raffle_winner
+@admin.route('/raffle_winners/<int:raffle_winner_id>/edit',
+              methods=['GET', 'POST'])
+@requires_auth
+def admin_edit_raffle_winner(raffle_winner_id):
+    raffle_winner = RaffleWinner.query.get(raffle_winner_id)
+    if request.method == 'GET':
+        form = RaffleWinnerForm(obj=raffle_winner)
+    else:
+        form = RaffleWinnerForm(obj=raffle_winner)
+        if form.validate_on_submit():
+            form.populate_obj(raffle_winner)
+            raffle_winner.updated_at = datetime.utcnow()
+            db_session.add(raffle_winner)
+            bump_raffle_winner_version()
+            db_session.commit()
+            return redirect(url_for('.admin_view_raffle_winners'))
+
+    return render_template('admin/raffle_winners/edit_raffle_winner.html',
+                           form=form, raffle_winner=raffle_winner)
+
+
+# admin delete_raffle_winner
+@admin.route('/raffle_winners/<int:raffle_winner_id>/delete',
+              methods=['POST'])
+@requires_auth
+def admin_delete_raffle_winner(raffle_winner_id):
+    raffle_winner = RaffleWinner.query.get(raffle_winner_id)
+    db_session.delete(raffle_winner)
+    bump_stats(winners=-1, claimed=-int(bool(raffle_winner.is_claimed)))
+    bump_raffle_winner_version()
+    db_session.commit()
+    return redirect(url_for('.admin_view_raffle_winners'))
+
+
+# admin claim_raffle_winner
+@admin.route('/raffle_winners/claim', methods=['POST'])
+@requires_auth
+def admin_claim_raffle_winner():
+    _claim_unclaim_raffle_winner(True)
+    return redirect(url_for('.admin_view_raffle_winners'))
+
+
+# admin unclaim_raffle_winner
+@admin.route('/raffle_winners/unclaim', methods=['POST'])
+@requires_auth
+def admin_unclaim_raffle_winner():
+    _claim_unclaim_raffle_winner(False)
+    return redirect(url_for('.admin_view_raffle_winners'))
+
+
+def _claim_unclaim_raffle_winner(claim):
+    raffle_winner_id = request.values.get('raffle_id', None)
+    if raffle_winner_id:
+        raffle_winner = RaffleWinner.query.filter(
+            RaffleWinner.id == raffle_winner_id).with_for_update().first()
+        if raffle_winner:
+            if bool(raffle_winner.is_claimed) != claim:
+                bump_stats(claimed=1 if claim else -1)
+            raffle_winner.is_claimed = claim
+            db_session.add(raffle_winner)
+            db_session.add(RaffleEvent(
+                'winner_claimed' if claim else 'winner_unclaimed',
+                raffle_winner.raffle_number,
+                raffle_winner.item))
+            bump_raffle_winner_version()
+            db_session.commit()
+            shared_state.publish(RAFFLE_EVENTS_CHANNEL)
+
+
+# admin notify_raffle_winner
+@admin.route('/raffle_winners/notify', methods=['POST'])
+@requires_auth
+def admin_notify_raffle_winner():
+    raffle_winner_id = request.values.get('raffle_id', None)
+    if raffle_winner_id:
+        # FOR UPDATE serializes concurrent notifies of the same winner across
+        # app nodes on PostgreSQL; SQLite already serializes writers.
+        raffle_winner = RaffleWinner.query.filter(
+            RaffleWinner.id == raffle_winner_id).with_for_update().first()
+        winners = PhoneNumber.query.join(WinnerMatch, WinnerMatch.phone_number_id == PhoneNumber.id).filter(WinnerMatch.raffle_winner_id == raffle_winner.id).all()
+        if winners:
+            for winner in winners:
+                _enqueue_notification(winner.phone_number, WINNER_COPY)
+
+                audit = Audit("Admin notified {0} that they've won a prize for claiming {1}".format(winner.phone_number, raffle_winner.raffle_number),
+                              phone_number=winner.phone_number,
+                              raffle_number=raffle_winner.raffle_number)
+                db_session.add(audit)
+
+            matched_ids = db_session.query(
+                WinnerMatch.phone_number_raffle_number_id).filter(
+                WinnerMatch.raffle_winner_id == raffle_winner.id)
+            db_session.execute(PhoneNumberRaffleNumber.__table__.update().
+                where(PhoneNumberRaffleNumber.id.in_(matched_ids)).
+                values(num_admin_notified=PhoneNumberRaffleNumber.num_admin_notified + 1))
+            db_session.execute(RaffleWinner.__table__.update().
+                where(RaffleWinner.id == raffle_winner.id).
+                values(num_admin_notified=RaffleWinner.num_admin_notified + 1))
+            bump_stats(admin_notifications=len(winners))
+            db_session.commit()
+            outbound_message_sender.wake()
+        else:
+            flash('No phone number has claimed this raffle number, so a notification at this time is unnecessary.')
+    return redirect(url_for('.admin_view_raffle_winners'))
+
+
+# admin view_phone_numbers
+@admin.route('/phone_numbers', methods=['GET'])
+@requires_auth
+def admin_view_phone_numbers():
+    after = request.args.get('after', 0, type=int)
+    page_size = current_app.config['ADMIN_PAGE_SIZE']
+    phone_numbers = PhoneNumber.query.\
+        options(subqueryload(PhoneNumber.raffle_numbers)).\
+        filter(PhoneNumber.id > after).\
+        order_by(PhoneNumber.id).\
+        limit(page_size + 1).all()
+    next_after = None
+    if len(phone_numbers) > page_size:
+        phone_numbers = phone_numbers[:page_size]
+        next_after = phone_numbers[-1].id
+    matched_ids = set()
+    if phone_numbers:
+        matched_ids = set(row.phone_number_raffle_number_id for row in
+                          db_session.query(
+                              WinnerMatch.phone_number_raffle_number_id).filter(
+                              WinnerMatch.phone_number_id.in_(
+                                  [number.id for number in phone_numbers])))
+    return render_template('admin/phone_numbers/view_phone_numbers.html',
+                           phone_numbers=phone_numbers,
+                           matched_ids=matched_ids,
+                           after=after,
+                           next_after=next_after)
+
+
+def _bump_phone_number_stats():
+    """Counts the phone numbers and raffle numbers the session is about to
+    insert or delete, since the phone number forms edit both."""
+    def count(objects, model):
+        return sum(isinstance(obj, model) for obj in objects)
+
+    bump_stats(
+        phone_numbers=count(db_session.new, PhoneNumber) -
+        count(db_session.deleted, PhoneNumber),
+        submissions=count(db_session.new, PhoneNumberRaffleNumber) -
+        count(db_session.deleted, PhoneNumberRaffleNumber))
+
+
+# admin add_phone_number
+@admin.route('/phone_numbers/add', methods=['GET', 'POST'])
+@requires_auth
+def admin_add_phone_number():
+    form = PhoneNumberForm()
+
+    if form.validate_on_submit():
+        phone_number = PhoneNumber()
+        form.populate_obj(phone_number)
+        phone_number.updated_at = datetime.utcnow()
+        phone_number.created_at = datetime.utcnow()
+        db_session.add(phone_number)
+        _bump_phone_number_stats()
+        db_session.commit()
+        return redirect(url_for('.admin_view_phone_numbers'))
+
+    return render_template('admin/phone_numbers/add_phone_number.html', form=form)
+
+
+# admin edit_phone_number
+@admin.route('/phone_numbers/<int:phone_number_id>/edit',
+              methods=['GET', 'POST'])
+@requires_auth
+def admin_edit_phone_number(phone_number_id):
+    phone_number = PhoneNumber.query.get(phone_number_id)
+    if request.method == 'GET':
+        form = PhoneNumberForm(obj=phone_number)
+    else:
+        form = PhoneNumberForm(obj=phone_number)
+        if form.validate_on_submit():
+            form.populate_obj(phone_number)
+            phone_number.updated_at = datetime.utcnow()
+            db_session.add(phone_number)
+            _bump_phone_number_stats()
+            db_session.commit()
+            return redirect(url_for('.admin_view_phone_numbers'))
+
+    return render_template('admin/phone_numbers/edit_phone_number.html',
+                           form=form, phone_number=phone_number)
+
+
+# admin delete_phone_number
+@admin.route('/phone_numbers/<int:phone_number_id>/delete',
+              methods=['POST'])
+@requires_auth
+def admin_delete_phone_number(phone_number_id):
+    phone_number = PhoneNumber.query.get(phone_number_id)
+    db_session.delete(phone_number)
+    _bump_phone_number_stats()
+    db_session.commit()
+    return redirect(url_for('.admin_view_phone_numbers'))
+
+
+# admin view_phone_number_raffle_number
+@admin.route('/phone_number_raffle_numbers/<string:raffle_number>', methods=['GET'])
+@requires_auth
+def admin_view_phone_number_raffle_number_by_raffle_number(raffle_number):
+    phone_number_raffle_numbers = PhoneNumberRaffleNumber.query.\
+        join(WinnerMatch, WinnerMatch.phone_number_raffle_number_id == PhoneNumberRaffleNumber.id).\
+        filter(WinnerMatch.raffle_number == raffle_number).\
+        options(joinedload(PhoneNumberRaffleNumber.phone_number)).all()
+    return render_template('admin/phone_numbers_raffle_numbers/view_phone_numbers_raffle_numbers_by_raffle_number.html',
+                           phone_number_raffle_numbers=phone_number_raffle_numbers,
+                           raffle_number=raffle_number)
+
+
+# admin add_phone_number_raffle_number
+@admin.route('/phone_numbers/<int:phone_number_id>/raffle_numbers/add',
+              methods=['GET', 'POST'])
+@requires_auth
+def admin_add_phone_number_raffle_number(phone_number_id):
+    phone_number = PhoneNumber.query.get(phone_number_id)
+    form = PhoneNumberRaffleNumberForm()
+
+    if form.validate_on_submit():
+        pn_rn = PhoneNumberRaffleNumber()
+        form.populate_obj(pn_rn)
+        pn_rn.phone_number_id = phone_number_id
+        pn_rn.updated_at = datetime.utcnow()
+        pn_rn.created_at = datetime.utcnow()
+        db_session.add(pn_rn)
+        _bump_phone_number_stats()
+        db_session.commit()
+        return redirect(url_for('.admin_view_phone_numbers'))
+
+    return render_template('admin/phone_numbers/add_raffle_number.html',
+            form=form, phone_number=phone_number)
+
+
+# admin delete_phone_number_raffle_number
+@admin.route('/phone_numbers/<int:phone_number_id>/raffle_numbers/<int:phone_number_raffle_number_id>/delete',
+              methods=['POST'])
+@requires_auth
+def admin_delete_phone_number_raffle_number(phone_number_id, phone_number_raffle_number_id):
+    phone_number_raffle_number = PhoneNumberRaffleNumber.query.get(phone_number_raffle_number_id)
+    phone_number_id = phone_number_raffle_number.phone_number.id
+    db_session.delete(phone_number_raffle_number)
+    _bump_phone_number_stats()
+    db_session.commit()
+    return redirect(url_for('.admin_edit_phone_number',
+        phone_number_id=phone_number_id))
+
+
+# admin export
+@admin.route('/export/<string:name>.<string:export_format>', methods=['GET'])
+@requires_auth
+def admin_export(name, export_format):
+    if name not in EXPORTS or export_format not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        since = _parse_export_time(request.args.get('since', None))
+        until = _parse_export_time(request.args.get('until', None))
+    except ValueError:
+        return Response('since and until must look like {0}\n'.format(
+            RAFFLE_TIME_FORMAT), 400)
+
+    mimetype, serialize = EXPORT_FORMATS[export_format]
+    rows = serialize(export_rows(name, since, until))
+    return Response(stream_with_context(rows), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename={0}.{1}'.format(
+            name, export_format)})
+
+
+def _parse_export_time(value):
+    if not value:
+        return None
+    return datetime.strptime(value, RAFFLE_TIME_FORMAT)
+
+
+# admin view_audits
+@admin.route('/audits', methods=['GET'])
+@requires_auth
+def admin_view_audits():
+    phone_number = request.args.get('phone_number', '').strip()
+    raffle_number = request.args.get('raffle_number', '').strip()
+    before = _parse_audit_cursor(request.args.get('before', None))
+    page_size = current_app.config['ADMIN_PAGE_SIZE']
+
+    audits = Audit.query
+    if phone_number:
+        audits = audits.filter(Audit.phone_number == phone_number)
+    if raffle_number:
+        audits = audits.filter(Audit.raffle_number == raffle_number)
+    if before:
+        before_created_at, before_id = before
+        audits = audits.filter(or_(
+            Audit.created_at < before_created_at,
+            and_(Audit.created_at == before_created_at,
+                 Audit.id < before_id)))
+    audits = audits.order_by(Audit.created_at.desc(), Audit.id.desc()).\
+        limit(page_size + 1).all()
+
+    next_before = None
+    if len(audits) > page_size:
+        audits = audits[:page_size]
+        next_before = '{0}_{1}'.format(
+            audits[-1].created_at.strftime(AUDIT_CURSOR_FORMAT), audits[-1].id)
+    return render_template('admin/audits/view_audits.html',
+                           audits=audits,
+                           phone_number=phone_number,
+                           raffle_number=raffle_number,
+                           before=before,
+                           next_before=next_before)
+
+
+AUDIT_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _parse_audit_cursor(cursor):
+    """Parses a (created_at, id) keyset cursor, ignoring malformed ones."""
+    try:
+        created_at, audit_id = cursor.rsplit('_', 1)
+        return datetime.strptime(created_at, AUDIT_CURSOR_FORMAT), int(audit_id)
+    except (AttributeError, ValueError):
+        return None
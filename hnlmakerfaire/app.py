@@ -1,80 +1,489 @@
 from datetime import datetime
-from flask import flash
+from datetime import timedelta
 from flask import Flask
+from flask import abort
 from flask import Response
 from flask import render_template
 from flask import url_for
-from flask import redirect
 from flask import request
 from flask import current_app
-from flask_wtf import Form
+from flask import session
+from flask import g
 from functools import wraps
-from pytz import timezone
-import pytz
+import base64
+import bisect
+import csv
+import fcntl
+import glob
+import hmac
+import json
+import mmap
+import os
+import Queue
+from StringIO import StringIO
+from collections import OrderedDict
+from hashlib import sha1
+from urllib import urlencode
 import re
+import struct
+import threading
+import time
+import atexit
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import UniqueConstraint
 
+from sqlalchemy import case
 from sqlalchemy import create_engine
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy import func
+from sqlalchemy import event
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Insert
 from sqlalchemy.sql import and_
+from sqlalchemy.sql import or_
 from sqlalchemy.ext.declarative import declarative_base
 
 from twilio import twiml
-from twilio.rest import TwilioRestClient
-from twilio.util import RequestValidator
-from urlobject import URLObject
-from wtforms import StringField
-from wtforms import TextAreaField
-from wtforms import IntegerField
-from wtforms_alchemy import ModelFieldList
-from wtforms_alchemy import model_form_factory
-from wtforms.fields import FormField
-from wtforms_components import DateRange
-from wtforms_components import DateTimeField
-from wtforms.validators import DataRequired
-from wtforms.validators import Optional
-from wtforms.widgets import HiddenInput
-from wtforms.widgets import ListWidget
-from wtforms.widgets import TableWidget
-from wtforms.widgets import TextInput
+from twilio.util import secure_compare
 
 WINNER_COPY = """ You may have won a prize at the Honolulu Makerfaire! Please report to the prize booth immediately.\n\nPowered by hicapacity.org"""
 LOSER_COPY = """ You haven't won yet, but who knows what the future holds for you at the Honolulu Makerfaire?\n\nPowered by hicapacity.org"""
 
 # Application
 
-app = Flask(__name__, static_url_path='/static')
+class HnlMakerfaireFlask(Flask):
+    def get_send_file_max_age(self, filename):
+        # build_static.py's fingerprinted copies never change, so browsers
+        # may keep them; nginx serves them the same way in production
+        if filename.startswith('build/'):
+            return self.config['STATIC_BUILD_MAX_AGE']
+        return Flask.get_send_file_max_age(self, filename)
+
+
+app = HnlMakerfaireFlask(__name__, static_url_path='/static')
 app.config.from_pyfile('local_settings.py')
 app.debug = app.config.get('ENVIRONMENT', None) == 'Development'
 
 
+# Static assets
+
+class StaticManifest(object):
+    """Maps static filenames to the fingerprinted copies written by
+    build_static.py. Without a build (e.g. in development) the files are
+    linked under their own names. build_id and built_at identify the build
+    (both None without one), for pages that link it to validate against.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._paths = None
+        self.build_id = None
+        self.built_at = None
+
+    def load(self):
+        if self._paths is None:
+            try:
+                with open(self.path) as f:
+                    content = f.read()
+                self.build_id = sha1(content).hexdigest()[:10]
+                self.built_at = datetime.utcfromtimestamp(
+                    int(os.path.getmtime(self.path)))
+                self._paths = dict((name, 'build/' + path)
+                                   for name, path in json.loads(content).items())
+            except IOError:
+                self._paths = {}
+        return self
+
+    def url(self, filename):
+        return url_for('static',
+                       filename=self.load()._paths.get(filename, filename))
+
+
+static_manifest = StaticManifest(app.config['STATIC_MANIFEST'])
+
+
+@app.template_global()
+def static_url(filename):
+    return static_manifest.url(filename)
+
+
 # Database
 
-engine = create_engine('sqlite:///' + app.config.get('DATABASE'),
-                       convert_unicode=True)
+def get_database_url():
+    """DATABASE_URL if set, otherwise the SQLite file at DATABASE."""
+    return make_url(app.config.get('DATABASE_URL') or
+                    'sqlite:///' + app.config.get('DATABASE'))
+
+
+def create_database_engine(url):
+    options = {
+        'convert_unicode': True,
+        'poolclass': QueuePool,
+        'pool_size': app.config.get('DATABASE_POOL_SIZE'),
+        'max_overflow': app.config.get('DATABASE_MAX_OVERFLOW'),
+    }
+    if app.config.get('DATABASE_ISOLATION_LEVEL'):
+        options['isolation_level'] = app.config.get('DATABASE_ISOLATION_LEVEL')
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {
+            'timeout': app.config.get('DATABASE_BUSY_TIMEOUT') / 1000.0,
+            'check_same_thread': False}
+    return create_engine(url, **options)
+
+
+engine = create_database_engine(get_database_url())
+
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode={0}'.format(
+        app.config.get('DATABASE_JOURNAL_MODE')))
+    cursor.execute('PRAGMA synchronous={0}'.format(
+        app.config.get('DATABASE_SYNCHRONOUS')))
+    cursor.execute('PRAGMA busy_timeout={0:d}'.format(
+        app.config.get('DATABASE_BUSY_TIMEOUT')))
+    cursor.close()
+
+
+
+class InsertIgnore(Insert):
+    """INSERT that silently skips rows violating a unique constraint, so
+    its rowcount tells the caller whether the row was new.
+    """
+
+
+@compiles(InsertIgnore)
+def compile_insert_ignore(insert, compiler, **kw):
+    raise CompileError(
+        'InsertIgnore has no compiler for the {0} dialect; add one next to '
+        'the sqlite, postgresql and mysql ones'.format(compiler.dialect.name))
+
+
+@compiles(InsertIgnore, 'sqlite')
+def compile_insert_ignore_sqlite(insert, compiler, **kw):
+    return compiler.visit_insert(insert.prefix_with('OR IGNORE'), **kw)
+
+
+@compiles(InsertIgnore, 'postgresql')
+def compile_insert_ignore_postgresql(insert, compiler, **kw):
+    return compiler.visit_insert(insert, **kw) + ' ON CONFLICT DO NOTHING'
+
+
+@compiles(InsertIgnore, 'mysql')
+def compile_insert_ignore_mysql(insert, compiler, **kw):
+    return compiler.visit_insert(insert.prefix_with('IGNORE'), **kw)
+
+
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
-BaseModelForm = model_form_factory(Form)
+# Shared state
+
+RAFFLE_EVENTS_CHANNEL = 'raffle_events'
+
+
+class TokenBuckets(object):
+    """Token buckets kept in a memory-mapped file, so that every worker on
+    this host shares them. The file is a table of slots of (key hash,
+    tokens, updated at) grouped in sets of SLOTS_PER_SET; a key lives in
+    its set and, when the set is full, takes over the slot of the set's
+    least recently used key. A set is locked with fcntl on its byte range
+    between processes, and with a lock per process between threads.
+    """
+
+    SLOT = struct.Struct('=Qdd')
+    SLOTS_PER_SET = 4
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = self.slots * self.SLOT.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = os.getpid()
+
+    def take(self, key, rate, burst):
+        """Takes a token from key's bucket, which holds up to burst tokens
+        and refills at rate tokens a second. Returns False if it is empty.
+        """
+        digest = struct.unpack('=Q', sha1(key.encode('utf-8')).digest()[:8])[0] or 1
+        first = digest % (self.slots // self.SLOTS_PER_SET) * self.SLOTS_PER_SET
+        start = first * self.SLOT.size
+        length = self.SLOTS_PER_SET * self.SLOT.size
+        now = time.time()
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                slot, tokens, updated = None, burst, now
+                oldest = None
+                for i in range(first, first + self.SLOTS_PER_SET):
+                    slot_digest, slot_tokens, slot_updated = \
+                        self.SLOT.unpack_from(self._map, i * self.SLOT.size)
+                    if slot_digest == digest:
+                        slot, tokens, updated = i, slot_tokens, slot_updated
+                        break
+                    if oldest is None or slot_updated < oldest[1]:
+                        oldest = (i, slot_updated)
+                if slot is None:
+                    slot = oldest[0]
+                tokens = min(burst, tokens + (now - updated) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                self.SLOT.pack_into(self._map, slot * self.SLOT.size,
+                                    digest, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+        return allowed
+
+
+class LocalSharedState(object):
+    """Shared state that is not shared beyond this host: nothing is cached
+    outside this process, so callers fall back to the database, published
+    messages only reach listeners in this process, and rate limits are
+    shared by this host's workers through token_buckets. Used unless
+    SHARED_STATE_URL is set.
+    """
+
+    def __init__(self, token_buckets=None):
+        self.token_buckets = token_buckets
+        self._listeners = {}
+        self._lock = threading.Lock()
 
-class ModelForm(BaseModelForm):
-    @classmethod
-    def get_session(self):
-        return db_session
+    def take_token(self, key, rate, burst):
+        return self.token_buckets.take(key, rate, burst)
 
+    def get_winners_version_stamp(self):
+        return None
+
+    def set_winners_version_stamp(self, version, updated_at):
+        pass
+
+    def get_winning_numbers(self, version):
+        return None
+
+    def set_winning_numbers(self, version, raffle_numbers):
+        pass
+
+    def get_webhook_response(self, sms_sid):
+        return None
+
+    def set_webhook_response(self, sms_sid, response, ttl):
+        pass
+
+    def publish(self, channel, message=''):
+        with self._lock:
+            listeners = list(self._listeners.get(channel, ()))
+        for listener in listeners:
+            listener(message)
+
+    def subscribe(self, channel, listener):
+        with self._lock:
+            self._listeners.setdefault(channel, []).append(listener)
+
+
+def _redis_fallback(default=None):
+    """Logs Redis errors raised by a RedisSharedState method and returns
+    default instead, which is what LocalSharedState would have returned.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(self, *args, **kwargs):
+            try:
+                return f(self, *args, **kwargs)
+            except self.errors as e:
+                app.logger.error('Shared state unavailable, falling back: '
+                                 '{0}'.format(e))
+                return default
+        return decorated
+    return decorator
+
+
+class RedisSharedState(LocalSharedState):
+    """Shared state kept in Redis (or anything speaking its protocol) so
+    that app nodes behind one load balancer share the winner version stamp,
+    the winning numbers and webhook replies, and wake each other's event
+    streams. Cached values expire after SHARED_STATE_TTL seconds, so a node
+    that dies between committing and publishing cannot leave them stale for
+    long. While Redis is unavailable every call behaves like
+    LocalSharedState's: callers fall back to the database, messages only
+    reach this process and rate limits fail open. Needs the redis package.
+    """
+
+    def __init__(self, url, prefix, ttl, client=None):
+        super(RedisSharedState, self).__init__()
+        import redis
+        if client is None:
+            client = redis.StrictRedis.from_url(url)
+        self.redis = client
+        self.errors = redis.RedisError
+        self.prefix = prefix
+        self.ttl = ttl
+        self._pid = None
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    @_redis_fallback()
+    def get_winners_version_stamp(self):
+        value = self.redis.get(self._key('winners', 'version'))
+        if value is None:
+            return None
+        version, updated_at = value.decode('utf-8').split('|', 1)
+        return int(version), (datetime.strptime(updated_at, RAFFLE_TIME_FORMAT)
+                              if updated_at else None)
+
+    @_redis_fallback()
+    def set_winners_version_stamp(self, version, updated_at):
+        """Stores the stamp unless a newer one is already stored, so a
+        reader that loaded an old stamp cannot overwrite a writer's.
+        """
+        key = self._key('winners', 'version')
+        value = '{0}|{1}'.format(version, updated_at.strftime(
+            RAFFLE_TIME_FORMAT) if updated_at else '')
+
+        def update(pipe):
+            current = pipe.get(key)
+            if current is not None and \
+                    int(current.decode('utf-8').split('|', 1)[0]) > version:
+                return
+            pipe.multi()
+            pipe.set(key, value, ex=self.ttl)
+
+        self.redis.transaction(update, key)
+
+    @_redis_fallback()
+    def get_winning_numbers(self, version):
+        value = self.redis.get(self._key('winners', version))
+        if value is None:
+            return None
+        return frozenset(json.loads(value.decode('utf-8')))
+
+    @_redis_fallback()
+    def set_winning_numbers(self, version, raffle_numbers):
+        self.redis.set(self._key('winners', version),
+                       json.dumps(sorted(raffle_numbers)), ex=self.ttl)
+
+    @_redis_fallback()
+    def get_webhook_response(self, sms_sid):
+        value = self.redis.get(self._key('webhook', sms_sid))
+        return value.decode('utf-8') if value is not None else None
+
+    @_redis_fallback()
+    def set_webhook_response(self, sms_sid, response, ttl):
+        self.redis.set(self._key('webhook', sms_sid), response, ex=ttl)
+
+    @_redis_fallback(default=True)
+    def take_token(self, key, rate, burst):
+        key = self._key('rate', key)
+
+        def update(pipe):
+            tokens, updated = pipe.hmget(key, 'tokens', 'updated')
+            now = time.time()
+            tokens = burst if tokens is None else \
+                min(burst, float(tokens) + (now - float(updated)) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            pipe.multi()
+            pipe.hmset(key, {'tokens': tokens, 'updated': now})
+            pipe.expire(key, int(burst / rate) + 1)
+            return allowed
+
+        return self.redis.transaction(update, key, value_from_callable=True)
+
+    def publish(self, channel, message=''):
+        try:
+            self.redis.publish(self._key('channel', channel), message)
+        except self.errors as e:
+            app.logger.error('Shared state unavailable, publishing locally: '
+                             '{0}'.format(e))
+            LocalSharedState.publish(self, channel, message)
+
+    def subscribe(self, channel, listener):
+        super(RedisSharedState, self).subscribe(channel, listener)
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._listen,
+                                      name='shared-state-listener')
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self._key('channel', '*'))
+                for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    channel = message['channel'].decode('utf-8')[
+                        len(self._key('channel', '')):]
+                    LocalSharedState.publish(self, channel,
+                                             message['data'].decode('utf-8'))
+            except Exception as e:
+                app.logger.exception(e)
+                time.sleep(1)
+
+
+def create_shared_state():
+    if app.config.get('SHARED_STATE_URL'):
+        return RedisSharedState(app.config['SHARED_STATE_URL'],
+                                app.config['SHARED_STATE_PREFIX'],
+                                app.config['SHARED_STATE_TTL'])
+    return LocalSharedState(TokenBuckets(app.config['RATE_LIMIT_FILE'],
+                                         app.config['RATE_LIMIT_SLOTS']))
+
+
+shared_state = create_shared_state()
+
+
+@event.listens_for(db_session.session_factory, 'after_commit')
+def publish_committed_shared_state(session):
+    """Publishes what the committed transaction changed, once it is
+    visible to every other node.
+    """
+    stamp = session.info.pop('winners_version_stamp', None)
+    if stamp is not None:
+        shared_state.set_winners_version_stamp(*stamp)
+
+
+@event.listens_for(db_session.session_factory, 'after_rollback')
+def discard_uncommitted_shared_state(session):
+    session.info.pop('winners_version_stamp', None)
 
 
 # Basic Auth
@@ -109,7 +518,7 @@ def requires_auth(f):
 class PhoneNumber(Base):
     __tablename__ = 'PhoneNumber'
     id = Column(Integer, primary_key=True)
-    phone_number = Column(String(32), unique=True, info={'label': 'Phone Number', 'validators': [DataRequired()]})
+    phone_number = Column(String(32), unique=True, info={'label': 'Phone Number'})
     raffle_numbers = relationship(
         'PhoneNumberRaffleNumber',
         backref='phone_number'
@@ -133,15 +542,34 @@ class PhoneNumberRaffleNumber(Base):
     )
     id = Column(Integer, primary_key=True)
     raffle_number = Column(String(8), nullable=False, info={'label': 'Raffle Number' })
-    phone_number_id = Column(Integer, ForeignKey('PhoneNumber.id'))
+    phone_number_id = Column(Integer, ForeignKey('PhoneNumber.id'), index=True)
     num_system_notified = Column(Integer, default=0)
     num_admin_notified = Column(Integer, default=0)
     updated_at = Column(DateTime)
     created_at = Column(DateTime)
 
 
+RAFFLE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+_hst = None
+
+
 def get_hst_time():
-    return datetime.now(tz=pytz.utc).astimezone(timezone('US/Hawaii')).replace(tzinfo=None)
+    global _hst
+    if _hst is None:
+        # importing pytz checks every zone file it knows of, so only the
+        # first caller pays for it
+        import pytz
+        _hst = pytz.timezone('US/Hawaii')
+    return datetime.now(tz=_hst).replace(tzinfo=None)
+
+
+def utc_to_hst(value):
+    """Converts a naive UTC time to the naive HST time Audit rows use."""
+    import pytz
+    get_hst_time()
+    return pytz.utc.localize(value).astimezone(_hst).replace(tzinfo=None)
 
 
 class RaffleWinner(Base):
@@ -150,11 +578,10 @@ class RaffleWinner(Base):
     raffle_number = Column(String(8), nullable=False, unique=True, info={'label': 'Raffle Number'})
     raffle_time = Column(DateTime, nullable=False,
         info={'label':'Raffle Time',
-        'widget': TextInput(),
         'min': datetime(2015, 5, 15, 0, 0, 0).replace(tzinfo=None),
         'max': datetime(2015, 5, 15, 23, 59, 59).replace(tzinfo=None)})
     item = Column(String(256), nullable=False, info={'label': 'Raffle Prize'})
-    is_claimed = Column(Boolean)
+    is_claimed = Column(Boolean, index=True)
     num_system_notified = Column(Integer, default=0)
     num_admin_notified = Column(Integer, default=0)
     updated_at = Column(DateTime)
@@ -174,20 +601,480 @@ class RaffleWinner(Base):
     def __repr__(self):
         return '<Raffle Winner %r>' % (self.raffle_number)
 
+class RaffleWinnerVersion(Base):
+    __tablename__ = 'RaffleWinnerVersion'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+    def __init__(self, version=0, updated_at=None):
+        self.version = version
+        self.updated_at = updated_at
+
+    def __repr__(self):
+        return '<Raffle Winner Version %r>' % (self.version)
+
+
+class WinnerMatch(Base):
+    """A submitted raffle number matching a drawn raffle winner. Kept up to
+    date whenever winners or submissions are saved (see
+    rematch_raffle_numbers), so notifying winners and the admin views find
+    matches with one indexed lookup instead of joining on raffle numbers.
+    """
+    __tablename__ = 'WinnerMatch'
+    __table_args__ = (
+        UniqueConstraint('raffle_winner_id', 'phone_number_raffle_number_id',
+                         name='uix_winner_match'),
+    )
+    id = Column(Integer, primary_key=True)
+    raffle_winner_id = Column(Integer, ForeignKey('RaffleWinner.id'),
+                              nullable=False)
+    phone_number_raffle_number_id = Column(
+        Integer, ForeignKey('PhoneNumberRaffleNumber.id'), nullable=False,
+        index=True)
+    phone_number_id = Column(Integer, ForeignKey('PhoneNumber.id'), index=True)
+    raffle_number = Column(String(8), nullable=False, index=True)
+
+    def __repr__(self):
+        return '<Winner Match %r>' % (self.raffle_number)
+
+
+def _winner_match_select(criterion):
+    return select([RaffleWinner.id,
+                   PhoneNumberRaffleNumber.id,
+                   PhoneNumberRaffleNumber.phone_number_id,
+                   PhoneNumberRaffleNumber.raffle_number]).\
+        select_from(PhoneNumberRaffleNumber.__table__.join(
+            RaffleWinner.__table__,
+            RaffleWinner.raffle_number == PhoneNumberRaffleNumber.raffle_number)).\
+        where(and_(criterion, PhoneNumberRaffleNumber.phone_number_id != None))
+
+
+def _winner_match_insert(criterion):
+    return WinnerMatch.__table__.insert().from_select(
+        ['raffle_winner_id', 'phone_number_raffle_number_id',
+         'phone_number_id', 'raffle_number'],
+        _winner_match_select(criterion))
+
+
+def match_submission(connection, phone_number_id, raffle_number):
+    """Adds the WinnerMatch for a newly inserted submission, if its raffle
+    number has been drawn.
+    """
+    connection.execute(_winner_match_insert(and_(
+        PhoneNumberRaffleNumber.phone_number_id == phone_number_id,
+        PhoneNumberRaffleNumber.raffle_number == raffle_number)))
+
+
+def rematch_raffle_numbers(connection, raffle_numbers):
+    """Recomputes the WinnerMatches of the given raffle numbers."""
+    raffle_numbers = sorted(set(n for n in raffle_numbers if n))
+    if not raffle_numbers:
+        return
+    connection.execute(WinnerMatch.__table__.delete().where(
+        WinnerMatch.raffle_number.in_(raffle_numbers)))
+    connection.execute(_winner_match_insert(
+        PhoneNumberRaffleNumber.raffle_number.in_(raffle_numbers)))
+
+
+def _changed_raffle_numbers(target, *keys):
+    """The old and new raffle numbers of target if any of keys changed."""
+    state = inspect(target)
+    if not any(state.attrs[key].history.has_changes() for key in keys):
+        return []
+    history = state.attrs.raffle_number.history
+    return list(history.deleted or ()) + list(history.unchanged or ()) + \
+        list(history.added or ())
+
+
+@event.listens_for(RaffleWinner, 'after_insert')
+@event.listens_for(PhoneNumberRaffleNumber, 'after_insert')
+def match_inserted(mapper, connection, target):
+    rematch_raffle_numbers(connection, [target.raffle_number])
+
+
+@event.listens_for(RaffleWinner, 'after_update')
+def rematch_updated_raffle_winner(mapper, connection, target):
+    rematch_raffle_numbers(connection,
+                           _changed_raffle_numbers(target, 'raffle_number'))
+
+
+@event.listens_for(PhoneNumberRaffleNumber, 'after_update')
+def rematch_updated_phone_number_raffle_number(mapper, connection, target):
+    rematch_raffle_numbers(connection, _changed_raffle_numbers(
+        target, 'raffle_number', 'phone_number_id'))
+
+
+@event.listens_for(RaffleWinner, 'before_delete')
+def unmatch_raffle_winner(mapper, connection, target):
+    connection.execute(WinnerMatch.__table__.delete().where(
+        WinnerMatch.raffle_winner_id == target.id))
+
+
+@event.listens_for(PhoneNumberRaffleNumber, 'before_delete')
+def unmatch_phone_number_raffle_number(mapper, connection, target):
+    connection.execute(WinnerMatch.__table__.delete().where(
+        WinnerMatch.phone_number_raffle_number_id == target.id))
+
+
+def check_winner_matches(repair=False):
+    """Compares WinnerMatch with the matches recomputed from scratch.
+    Returns (missing, unexpected) lists of (raffle_winner_id,
+    phone_number_raffle_number_id, phone_number_id, raffle_number); with
+    repair, rebuilds the table when they differ.
+    """
+    expected = set(tuple(row) for row in db_session.execute(
+        _winner_match_select(True)))
+    actual = set(tuple(row) for row in db_session.query(
+        WinnerMatch.raffle_winner_id,
+        WinnerMatch.phone_number_raffle_number_id,
+        WinnerMatch.phone_number_id,
+        WinnerMatch.raffle_number))
+    missing = sorted(expected - actual)
+    unexpected = sorted(actual - expected)
+    if repair and (missing or unexpected):
+        db_session.execute(WinnerMatch.__table__.delete())
+        db_session.execute(_winner_match_insert(True))
+        db_session.commit()
+    return missing, unexpected
+
+
+# Every stat is kept as a running total (minute STATS_EPOCH) and per minute
+STAT_NAMES = ['submissions', 'phone_numbers', 'duplicates',
+              'system_notifications', 'admin_notifications', 'winners',
+              'claimed']
+STATS_EPOCH = datetime(1970, 1, 1)
+
+
+class StatCounter(Base):
+    """Dashboard counters, bumped in the same transaction as the writes they
+    count so that reading them never scans the tables. Each process bumps
+    its own shard (pid % STATS_SHARDS) so that concurrent writers do not
+    queue on one hot row; readers sum the shards.
+    """
+    __tablename__ = 'StatCounter'
+    minute = Column(DateTime, primary_key=True)
+    name = Column(String(32), primary_key=True)
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    value = Column(Integer, nullable=False, default=0)
+
+
+def _seed_stats(shard, minutes):
+    db_session.execute(InsertIgnore(StatCounter.__table__), [
+        {'minute': minute, 'name': name, 'shard': shard, 'value': 0}
+        for minute in minutes for name in STAT_NAMES])
+
+
+def _update_stats(shard, minutes, deltas):
+    return db_session.execute(StatCounter.__table__.update().where(and_(
+        StatCounter.shard == shard,
+        StatCounter.minute.in_(minutes),
+        StatCounter.name.in_(deltas.keys()))).values(
+        value=StatCounter.value + case(deltas, value=StatCounter.name))).rowcount
+
+
+def bump_stats(**deltas):
+    """Adds deltas to the running totals and to the current minute within
+    the current transaction, usually with a single UPDATE.
+    """
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    shard = os.getpid() % app.config['STATS_SHARDS']
+    minute = datetime.utcnow().replace(second=0, microsecond=0)
+    updated = _update_stats(shard, [STATS_EPOCH, minute], deltas)
+    if updated < 2 * len(deltas):
+        # first bump of the minute on this shard (or of the shard itself)
+        minutes = [minute] if updated else [STATS_EPOCH, minute]
+        _seed_stats(shard, minutes)
+        _update_stats(shard, minutes, deltas)
+
+
+def get_stats():
+    """Returns the running totals by name."""
+    stats = dict((name, 0) for name in STAT_NAMES)
+    stats.update(db_session.query(StatCounter.name,
+                                  func.sum(StatCounter.value)).filter(
+        StatCounter.minute == STATS_EPOCH).group_by(StatCounter.name))
+    stats['unclaimed'] = stats['winners'] - stats['claimed']
+    stats['claim_rate'] = float(stats['claimed']) / stats['winners'] \
+        if stats['winners'] else 0.0
+    return stats
+
+
+def get_stats_by_minute(minutes):
+    """Returns [(minute, {name: value})] for the last minutes minutes,
+    oldest first, including minutes with nothing in them.
+    """
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    since = now - timedelta(minutes=minutes - 1)
+    rows = db_session.query(StatCounter.minute, StatCounter.name,
+                            func.sum(StatCounter.value)).filter(
+        StatCounter.minute >= since).group_by(StatCounter.minute,
+                                              StatCounter.name)
+    by_minute = dict((since + timedelta(minutes=i),
+                      dict((name, 0) for name in STAT_NAMES))
+                     for i in range(minutes))
+    for minute, name, value in rows:
+        if minute in by_minute:
+            by_minute[minute][name] = value
+    return sorted(by_minute.items())
+
+
+def get_raffle_winner_version():
+    return get_raffle_winner_version_stamp()[0]
+
+
+def get_raffle_winner_version_stamp():
+    """Returns (version, updated_at) of the raffle winners, from the shared
+    state when it has them.
+    """
+    stamp = shared_state.get_winners_version_stamp()
+    if stamp is None:
+        stamp = _load_raffle_winner_version_stamp()
+        shared_state.set_winners_version_stamp(*stamp)
+    return stamp
+
+
+def _load_raffle_winner_version_stamp():
+    stamp = db_session.query(RaffleWinnerVersion.version,
+                             RaffleWinnerVersion.updated_at).filter(
+        RaffleWinnerVersion.id == 1).first()
+    return tuple(stamp) if stamp else (0, None)
+
+
+def bump_raffle_winner_version():
+    """Bumps the raffle winner version within the current transaction so
+    every worker reloads its winning number index on its next lookup.
+    """
+    updated = RaffleWinnerVersion.__table__.update().\
+        where(RaffleWinnerVersion.id == 1).\
+        values(version=RaffleWinnerVersion.version + 1,
+               updated_at=datetime.utcnow())
+    if db_session.execute(updated).rowcount == 0:
+        db_session.add(RaffleWinnerVersion(1, datetime.utcnow()))
+        db_session.flush()
+    db_session().info['winners_version_stamp'] = \
+        _load_raffle_winner_version_stamp()
+
+
+class WinningNumberIndex(object):
+    """Process local set of winning raffle numbers, reloaded whenever the
+    raffle winner version stored in the database changes.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.raffle_numbers = frozenset()
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        version = get_raffle_winner_version()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    raffle_numbers = shared_state.get_winning_numbers(version)
+                    if raffle_numbers is None:
+                        raffle_numbers = frozenset(
+                            row.raffle_number for row in db_session.query(
+                                RaffleWinner.raffle_number))
+                        shared_state.set_winning_numbers(version,
+                                                         raffle_numbers)
+                    self.raffle_numbers = raffle_numbers
+                    self.version = version
+        return self
+
+    def __contains__(self, raffle_number):
+        return raffle_number in self.raffle_numbers
+
+
+winning_numbers = WinningNumberIndex()
+
+
+class WebhookResponse(Base):
+    __tablename__ = 'WebhookResponse'
+    sms_sid = Column(String(64), primary_key=True)
+    response = Column(String(2048), nullable=False)
+    created_at = Column(DateTime, index=True)
+
+    def __init__(self, sms_sid, response, created_at=None):
+        self.sms_sid = sms_sid
+        self.response = response
+        self.created_at = created_at or datetime.utcnow()
+
+    def __repr__(self):
+        return '<Webhook Response %r>' % (self.sms_sid)
+
+
+class RaffleEvent(Base):
+    __tablename__ = 'RaffleEvent'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(32), nullable=False)
+    raffle_number = Column(String(8), nullable=False)
+    item = Column(String(256))
+    created_at = Column(DateTime)
+
+    def __init__(self, kind, raffle_number, item=None, created_at=None):
+        self.kind = kind
+        self.raffle_number = raffle_number
+        self.item = item
+        self.created_at = created_at or datetime.utcnow()
+
+    def __repr__(self):
+        return '<Raffle Event %r %r>' % (self.kind, self.raffle_number)
+
+    def to_sse(self):
+        return 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(
+            self.id, self.kind, json.dumps({
+                'raffle_number': self.raffle_number,
+                'item': self.item}))
+
+
+class OutboundMessage(Base):
+    __tablename__ = 'OutboundMessage'
+    id = Column(Integer, primary_key=True)
+    to_number = Column(String(32), nullable=False)
+    body = Column(String(1600), nullable=False)
+    status = Column(String(16), nullable=False, default='pending')
+    attempts = Column(Integer, default=0)
+    send_after = Column(DateTime)
+    sid = Column(String(64))
+    last_error = Column(String(256))
+    updated_at = Column(DateTime)
+    created_at = Column(DateTime)
+
+    def __init__(self, to_number=None, body=None, status='pending',
+                 attempts=0, send_after=None, created_at=None,
+                 updated_at=None):
+        self.to_number = to_number
+        self.body = body
+        self.status = status
+        self.attempts = attempts
+        self.send_after = send_after
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def __repr__(self):
+        return '<Outbound Message %r %r>' % (self.to_number, self.status)
+
+
 class Audit(Base):
     __tablename__ = 'Audit'
     id = Column(Integer, primary_key=True)
     description = Column(String(256))
-    created_at = Column(DateTime)
+    phone_number = Column(String(32))
+    raffle_number = Column(String(8))
+    created_at = Column(DateTime, index=True)
+    __table_args__ = (
+        Index('ix_Audit_phone_number_created_at', 'phone_number', 'created_at'),
+        Index('ix_Audit_raffle_number_created_at', 'raffle_number', 'created_at'),
+    )
 
-    def __init__(self, description, created_at=None):
+    def __init__(self, description, created_at=None, phone_number=None,
+                 raffle_number=None):
         self.description = description
+        self.phone_number = phone_number
+        self.raffle_number = raffle_number
         self.created_at = created_at or get_hst_time()
 
     def __repr__(self):
         return '<Audit %r>' % (self.description)
 
 
+# Twilio
+
+class TwilioGateway(object):
+    """All of a worker's traffic with Twilio. It validates webhook
+    signatures with a precomputed HMAC key and a cached webhook URL, and it
+    sends SMS over one keep-alive HTTP connection per thread (twilio's
+    TwilioRestClient opens a new connection for every request).
+    """
+
+    def __init__(self, account_sid, auth_token, from_number,
+                 api_base='https://api.twilio.com', timeout=10):
+        self.from_number = from_number
+        self.timeout = timeout
+        self.messages_url = '{0}/2010-04-01/Accounts/{1}/Messages.json'.format(
+            api_base.rstrip('/'), account_sid)
+        self.authorization = 'Basic ' + base64.b64encode(
+            '{0}:{1}'.format(account_sid, auth_token))
+        self._mac = hmac.new(auth_token or '', digestmod=sha1)
+        self._validation_urls = {}
+        self._local = threading.local()
+
+    def validation_url(self):
+        """The URL Twilio signs for check_raffle, cached per host."""
+        url = self._validation_urls.get(request.host_url)
+        if url is None:
+            url = url_for('check_raffle', _external=True)
+            if len(self._validation_urls) < 16:
+                self._validation_urls[request.host_url] = url
+        return url
+
+    def compute_signature(self, url, params):
+        mac = self._mac.copy()
+        mac.update(url.encode('utf-8'))
+        for key, value in sorted(params.items()):
+            mac.update((key + value).encode('utf-8'))
+        return base64.b64encode(mac.digest())
+
+    def validate(self, url, params, signature):
+        return secure_compare(self.compute_signature(url, params), signature)
+
+    def _http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import httplib2
+            http = self._local.http = httplib2.Http(timeout=self.timeout)
+        return http
+
+    def send_sms(self, to, body):
+        """Sends an SMS, returning its sid."""
+        data = urlencode({'To': to.encode('utf-8'),
+                          'From': self.from_number.encode('utf-8'),
+                          'Body': body.encode('utf-8')})
+        try:
+            response, content = self._http().request(
+                self.messages_url, 'POST', body=data, headers={
+                    'Authorization': self.authorization,
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Accept': 'application/json'})
+        except Exception:
+            # drop the connection so the next send reconnects
+            self._local.http = None
+            raise
+        if response.status >= 400:
+            # twilio.rest loads every REST resource class on import
+            from twilio.rest.exceptions import TwilioRestException
+            raise TwilioRestException(response.status, self.messages_url,
+                                      content.decode('utf-8', 'replace'))
+        return json.loads(content)['sid']
+
+
+_twilio_gateway = None
+_twilio_gateway_lock = threading.Lock()
+
+
+def get_twilio_gateway():
+    """Returns this worker's Twilio gateway, creating it on first use."""
+    global _twilio_gateway
+    if _twilio_gateway is None:
+        with _twilio_gateway_lock:
+            if _twilio_gateway is None:
+                _twilio_gateway = TwilioGateway(
+                    app.config['TWILIO_ACCOUNT_SID'],
+                    app.config['TWILIO_AUTH_TOKEN'],
+                    app.config['TWILIO_NUMBER'],
+                    app.config['TWILIO_API_BASE'])
+    return _twilio_gateway
+
+
+def set_twilio_gateway(gateway):
+    """Swaps the Twilio gateway, e.g. for a fake one in tests."""
+    global _twilio_gateway
+    _twilio_gateway = gateway
+
+
 # Views
 def twilio_secure(func):
     """Wrap a view function to ensure that every request comes from Twilio."""
@@ -203,357 +1090,1014 @@ def twilio_secure(func):
 @app.route('/raffle_check', methods=['GET', 'POST'])
 @twilio_secure
 def check_raffle():
-    response = twiml.Response()
-    response_msg = ""
+    # Twilio retries replay the original reply without spending a token
+    sms_sid = request.form.get('SmsSid', None)
+    stored_response = webhook_responses.get(sms_sid)
+    if stored_response is not None:
+        return stored_response
+
+    if _is_throttled(request.values.get('From', None)):
+        return THROTTLED_REPLY
+
     try:
         sms_body = request.values.get('Body', None)
-        if sms_body:
-            searches = re.search(r'^[0-9]{1,4}$', sms_body.strip())
-            if searches:
-                raffle_number = searches.group()
-                sms_from = request.values.get('From', None)
-
-                if sms_from:
-                    # retrieve phone number
-                    number = PhoneNumber.query.filter(
-                        PhoneNumber.phone_number == sms_from.strip()).first()
-
-                    # if number found
-                    if number:
-                        found_number = [num for num in number.raffle_numbers
-                                        if num.raffle_number == raffle_number]
-                        if found_number:
-                            response_msg = \
-                                "You've already submitted this number."
-                            response.sms(response_msg)
-                            return str(response)
-                        else:
-                            phone_number_raffle_number = \
-                                PhoneNumberRaffleNumber(
-                                    raffle_number=raffle_number,
-                                    phone_number_id=number.id,
-                                    updated_at=datetime.utcnow(),
-                                    created_at=datetime.utcnow())
-                            number.raffle_numbers.append(
-                                phone_number_raffle_number)
-                            db_session.add(number)
-
-                            audit = Audit("{0} (existing) has saved {1}".format(sms_from.strip(), raffle_number))
-
-                            db_session.add(audit)
-                            db_session.commit()
-                    else:
-                        # save from and number
-                        phone_number = PhoneNumber(
-                            sms_from.strip(),
-                            datetime.utcnow(), datetime.utcnow())
-                        phone_number_raffle_number = PhoneNumberRaffleNumber(
-                            raffle_number=raffle_number,
-                            updated_at=datetime.utcnow(),
-                            created_at=datetime.utcnow())
-                        phone_number.raffle_numbers.append(
-                            phone_number_raffle_number)
-
-                        audit = Audit("{0} (new) has saved {1}".format(sms_from.strip(), raffle_number))
-
-                        db_session.add(audit)
-                        db_session.add(phone_number)
-                        db_session.commit()
-
-                    winner = RaffleWinner.query.filter(
-                        RaffleWinner.raffle_number == raffle_number).first()
-
-                    if winner:
-                        winner.num_system_notified += 1
-                        db_session.add(winner)
-
-                        try:
-                            phone_number_raffle_number = PhoneNumberRaffleNumber.query.filter(and_(PhoneNumberRaffleNumber.raffle_number == raffle_number, PhoneNumberRaffleNumber.phone_number_id == number.id)).one()
-
-                            if phone_number_raffle_number:
-                                phone_number_raffle_number.num_system_notified += 1
-                                db_session.add(phone_number_raffle_number)
-
-                            audit = Audit("System notified {0} that they've won a prize for {1}".format(number.phone_number, raffle_number))
-                            db_session.add(audit)
-
-                        except MultipleResultsFound, e:
-                            pass
-                        except NoResultFound, e:
-                            pass
-
-                        db_session.commit()
-
-                    response_msg = WINNER_COPY if winner else LOSER_COPY
-                else:
-                    return
-            else:
-                response_msg = "Please submit a valid 4-digit raffle number!"
-        else:
-            response_msg = "Please submit a valid 4-digit raffle number!"
+        searches = RAFFLE_NUMBER_RE.match(sms_body.strip()) if sms_body else None
+        if not searches:
+            return INVALID_NUMBER_REPLY
+        raffle_number = searches.group()
+
+        sms_from = request.values.get('From', None)
+        if not sms_from:
+            return EMPTY_REPLY
+        sms_from = sms_from.strip()
+
+        if current_app.config['INGEST_WRITE_BEHIND']:
+            return ingestion_log.submit(sms_sid, sms_from, raffle_number)
+
+        is_new, is_duplicate, phone_number_id = \
+            _submit_raffle_number(sms_from, raffle_number)
+        if is_duplicate:
+            bump_stats(duplicates=1)
+            webhook_responses.save(sms_sid, ALREADY_SUBMITTED_REPLY)
+            db_session.commit()
+            webhook_responses.remember(sms_sid, ALREADY_SUBMITTED_REPLY)
+            return ALREADY_SUBMITTED_REPLY
+
+        record_audit(_saved_audit_description(sms_from, raffle_number, is_new),
+                     sms_from, raffle_number)
+
+        winner = False
+        if raffle_number in winning_numbers.refresh():
+            winner = _system_notify_raffle_winner(phone_number_id,
+                                                  raffle_number)
+            if winner:
+                record_audit(_notified_audit_description(sms_from, raffle_number),
+                             sms_from, raffle_number)
+        bump_stats(submissions=1, phone_numbers=int(is_new),
+                   system_notifications=int(winner))
+
+        reply = WINNER_REPLY if winner else LOSER_REPLY
+        webhook_responses.save(sms_sid, reply)
+        db_session.commit()
+        webhook_responses.remember(sms_sid, reply)
+        return reply
+    except Exception as e:
+        current_app.logger.exception(e)
+    return EMPTY_REPLY
+
+
+def _is_throttled(sms_from):
+    """Takes a token from the sender's bucket, shared by every worker, and
+    counts the request as shed if there was none left. Fails open.
+    """
+    config = current_app.config
+    if not config['RATE_LIMIT_ENABLED'] or not sms_from:
+        return False
+    try:
+        if shared_state.take_token('sms:' + sms_from.strip(),
+                                   config['RATE_LIMIT_PER_MINUTE'] / 60.0,
+                                   config['RATE_LIMIT_BURST']):
+            return False
     except Exception as e:
         current_app.logger.exception(e)
-    response.sms(response_msg)
+        return False
+    metrics.inc('hnlmakerfaire_throttled_total', {'endpoint': 'check_raffle'})
+    return True
+
+
+def _twiml_sms(message):
+    response = twiml.Response()
+    response.sms(message)
     return str(response)
 
 
-# admin index
-@app.route('/admin/', methods=['GET'])
-@requires_auth
-def admin_index():
-    return render_template('admin/index.html')
+# check_raffle only ever sends one of these, so render them once
+RAFFLE_NUMBER_RE = re.compile(r'^[0-9]{1,4}$')
+WINNER_REPLY = _twiml_sms(WINNER_COPY)
+LOSER_REPLY = _twiml_sms(LOSER_COPY)
+ALREADY_SUBMITTED_REPLY = _twiml_sms("You've already submitted this number.")
+INVALID_NUMBER_REPLY = _twiml_sms("Please submit a valid 4-digit raffle number!")
+EMPTY_REPLY = _twiml_sms("")
+THROTTLED_REPLY = _twiml_sms("Whoa, slow down! Please wait a minute before texting another number.")
 
 
-# admin view_raffle_winners
-@app.route('/admin/raffle_winners/', methods=['GET'])
-@requires_auth
-def admin_view_raffle_winners():
-    raffle_winners = RaffleWinner.\
-        query.all()
-    return render_template('admin/raffle_winners/view_raffle_winners.html',
-                           raffle_winners=raffle_winners)
+class WebhookResponseStore(object):
+    """Replies already given to the raffle_check webhook, keyed on Twilio's
+    SmsSid, so that Twilio's retries are answered with the original reply
+    and without any writes. Recent replies are kept in a bounded
+    per-process LRU; the WebhookResponse table, written in the same
+    transaction as the submission, makes them visible to every worker until
+    they expire after IDEMPOTENCY_TTL seconds.
+    """
 
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def get(self, sms_sid):
+        if not sms_sid:
+            return None
+        with self._lock:
+            entry = self._cache.get(sms_sid, None)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+
+        shared = shared_state.get_webhook_response(sms_sid)
+        if shared is not None:
+            self._remember_locally(sms_sid, shared)
+            return shared
+
+        expired = datetime.utcnow() - \
+            timedelta(seconds=app.config['IDEMPOTENCY_TTL'])
+        stored = db_session.query(WebhookResponse.response).filter(and_(
+            WebhookResponse.sms_sid == sms_sid,
+            WebhookResponse.created_at > expired)).scalar()
+        if stored is not None:
+            self._remember_locally(sms_sid, stored)
+        return stored
+
+    def save(self, sms_sid, response):
+        """Stores a reply in the current transaction."""
+        if not sms_sid:
+            return
+        now = datetime.utcnow()
+        db_session.add(WebhookResponse(sms_sid, response, now))
+        self._saves += 1
+        if self._saves % app.config['IDEMPOTENCY_PURGE_EVERY'] == 0:
+            expired = now - timedelta(seconds=app.config['IDEMPOTENCY_TTL'])
+            db_session.execute(WebhookResponse.__table__.delete().where(
+                WebhookResponse.created_at <= expired))
+
+    def remember(self, sms_sid, response):
+        """Caches a committed reply in this process and the shared state."""
+        if not sms_sid:
+            return
+        shared_state.set_webhook_response(sms_sid, response,
+                                          app.config['IDEMPOTENCY_TTL'])
+        self._remember_locally(sms_sid, response)
+
+    def _remember_locally(self, sms_sid, response):
+        expires = time.time() + app.config['IDEMPOTENCY_TTL']
+        with self._lock:
+            self._cache.pop(sms_sid, None)
+            self._cache[sms_sid] = (response, expires)
+            while len(self._cache) > app.config['IDEMPOTENCY_CACHE_SIZE']:
+                self._cache.popitem(last=False)
+
+
+webhook_responses = WebhookResponseStore()
+
+
+def _saved_audit_description(sms_from, raffle_number, is_new):
+    return "{0} ({1}) has saved {2}".format(
+        sms_from, 'new' if is_new else 'existing', raffle_number)
+
+
+def _notified_audit_description(sms_from, raffle_number):
+    return "System notified {0} that they've won a prize for {1}".format(
+        sms_from, raffle_number)
+
+
+def _submit_raffle_number(sms_from, raffle_number, now=None):
+    """Saves a phone number / raffle number pair using a fixed number of
+    statements regardless of how many raffle numbers the phone number has
+    already submitted. Returns (is_new, is_duplicate, phone_number_id); the
+    caller is responsible for committing.
+    """
+    now = now or datetime.utcnow()
 
-# admin add_raffle_winner
-@app.route('/admin/raffle_winners/add', methods=['GET', 'POST'])
-@requires_auth
-def admin_add_raffle_winner():
-    form = RaffleWinnerForm()
-    if request.method == 'GET':
-        form.raffle_time.data = get_hst_time()
-    else:
-        if form.validate_on_submit():
-            raffle_winner = RaffleWinner()
-            form.populate_obj(raffle_winner)
-            raffle_winner.is_claimed = False
-            raffle_winner.updated_at = datetime.utcnow()
-            raffle_winner.created_at = datetime.utcnow()
+    phone_number_insert = InsertIgnore(PhoneNumber.__table__)
+    is_new = db_session.execute(phone_number_insert, {
+        'phone_number': sms_from,
+        'created_at': now,
+        'updated_at': now}).rowcount == 1
+
+    phone_number_id = db_session.query(PhoneNumber.id).filter(
+        PhoneNumber.phone_number == sms_from).scalar()
 
-            audit = Audit("Admin has drawn number {0} for prize {1}".format(raffle_winner.raffle_number, raffle_winner.item))
+    raffle_number_insert = InsertIgnore(PhoneNumberRaffleNumber.__table__)
+    is_duplicate = db_session.execute(raffle_number_insert, {
+        'raffle_number': raffle_number,
+        'phone_number_id': phone_number_id,
+        'created_at': now,
+        'updated_at': now}).rowcount == 0
+    if not is_duplicate:
+        match_submission(db_session, phone_number_id, raffle_number)
 
-            db_session.add(audit)
-            db_session.add(raffle_winner)
+    return is_new, is_duplicate, phone_number_id
+
+
+def _system_notify_raffle_winner(phone_number_id, raffle_number):
+    """Bumps the system notification counters for a winning submission.
+    Returns False if the raffle number is no longer a winner.
+    """
+    winner_update = RaffleWinner.__table__.update().\
+        where(RaffleWinner.raffle_number == raffle_number).\
+        values(num_system_notified=RaffleWinner.num_system_notified + 1)
+    if db_session.execute(winner_update).rowcount == 0:
+        return False
+
+    raffle_number_update = PhoneNumberRaffleNumber.__table__.update().\
+        where(and_(PhoneNumberRaffleNumber.raffle_number == raffle_number,
+                   PhoneNumberRaffleNumber.phone_number_id == phone_number_id)).\
+        values(num_system_notified=PhoneNumberRaffleNumber.num_system_notified + 1)
+    db_session.execute(raffle_number_update)
+    return True
+
+
+def _is_submitted(sms_from, raffle_number):
+    return db_session.query(PhoneNumberRaffleNumber.id).\
+        join(PhoneNumber).filter(and_(
+            PhoneNumber.phone_number == sms_from,
+            PhoneNumberRaffleNumber.raffle_number == raffle_number)).\
+        first() is not None
+
+
+class IngestionLog(object):
+    """Write-behind ingestion for raffle_check (INGEST_WRITE_BEHIND).
+
+    The webhook answers from the winning number index and a duplicate check
+    (submissions still pending in this process, then a read), appends the
+    submission to this worker's log file under INGEST_LOG_DIR and replies
+    without waiting for a commit. A background thread saves the logged
+    submissions in batches of up to INGEST_BATCH_SIZE per commit, and
+    truncates the log once everything in it has been saved. When it starts,
+    the thread replays the logs left behind by workers that died (including
+    ones a dead worker was itself replaying), retrying every
+    INGEST_RECOVERY_INTERVAL seconds while that fails. Saving a submission
+    is idempotent, so replaying one twice is harmless. A batch that still
+    fails after INGEST_SAVE_ATTEMPTS tries is saved one record at a time,
+    and the records that fail on their own are appended to
+    ingest-<pid>.dead (in the same format as the log) for an admin to look
+    at, so one bad record cannot hold up the rest.
+
+    A retry or duplicate landing on another worker before the batch is
+    saved may be answered as a new submission; it is still saved once.
+    Duplicates are counted in the stats with the next batch (in memory
+    only, so a crash can lose a few).
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, config):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.config = config
+            self._queue = Queue.Queue()
+            self._pending = set()
+            self._appended = 0
+            self._saved = 0
+            if not os.path.isdir(config['INGEST_LOG_DIR']):
+                os.makedirs(config['INGEST_LOG_DIR'])
+            self._path = os.path.join(config['INGEST_LOG_DIR'],
+                                      'ingest-{0}.log'.format(self._pid))
+            self._log = open(self._path, 'a')
+            thread = threading.Thread(target=self._run, name='ingestion-writer')
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, sms_sid, sms_from, raffle_number):
+        """Logs a submission and returns the reply for it."""
+        self.start(current_app.config)
+        key = (sms_from, raffle_number)
+        with self._lock:
+            if key in self._pending:
+                return self._duplicate(sms_sid)
+        # read outside the lock so webhooks only queue on the log write
+        if _is_submitted(sms_from, raffle_number):
+            return self._duplicate(sms_sid)
+
+        winner = raffle_number in winning_numbers.refresh()
+        reply = WINNER_REPLY if winner else LOSER_REPLY
+        record = {
+            'sms_sid': sms_sid,
+            'from': sms_from,
+            'raffle_number': raffle_number,
+            'winner': winner,
+            'reply': reply,
+            'created_at': datetime.utcnow().strftime(INGEST_TIME_FORMAT),
+            'audited_at': get_hst_time().strftime(INGEST_TIME_FORMAT)}
+        with self._lock:
+            raced = key in self._pending  # with another thread
+            if not raced:
+                self._log.write(json.dumps(record) + '\n')
+                self._log.flush()
+                if self.config['INGEST_LOG_FSYNC']:
+                    os.fsync(self._log.fileno())
+                self._pending.add(key)
+                self._appended += 1
+                self._queue.put(record)
+        if raced:
+            return self._duplicate(sms_sid)
+
+        webhook_responses.remember(sms_sid, reply)
+        return reply
+
+    def _duplicate(self, sms_sid):
+        """Queues a duplicate text to be counted and its reply stored, and
+        remembers the reply so Twilio's retries get it meanwhile."""
+        self._queue.put({
+            'duplicate': True,
+            'sms_sid': sms_sid,
+            'reply': ALREADY_SUBMITTED_REPLY,
+            'created_at': datetime.utcnow().strftime(INGEST_TIME_FORMAT)})
+        webhook_responses.remember(sms_sid, ALREADY_SUBMITTED_REPLY)
+        return ALREADY_SUBMITTED_REPLY
+
+    def recover(self):
+        """Replays the logs of workers that are no longer running, and logs
+        that a dead worker (or an earlier attempt by this one) claimed but
+        did not finish replaying. Returns False if any log is left to retry.
+        """
+        recovered = True
+        for path in glob.glob(os.path.join(self.config['INGEST_LOG_DIR'],
+                                           'ingest-*.log*')):
+            log, _, owner = path.partition('.recovering-')
+            pid = int(log.rsplit('-', 1)[1].split('.')[0])
+            owner = int(owner) if owner else pid
+            if owner != self._pid and _is_running(owner):
+                continue
+            if owner == self._pid and not path.endswith(
+                    '.recovering-{0}'.format(self._pid)):
+                continue  # this worker's own log
+            claimed = '{0}.recovering-{1}'.format(log, self._pid)
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # another worker claimed it first
+            try:
+                count = self._replay(claimed)
+            except Exception as e:
+                app.logger.exception(e)
+                recovered = False
+                continue
+            os.remove(claimed)
+            app.logger.info('Recovered {0} submissions from {1}'.format(
+                count, log))
+        return recovered
+
+    def _replay(self, path):
+        with open(path) as f:
+            records = []
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # torn final write
+        for start in range(0, len(records), self.config['INGEST_BATCH_SIZE']):
+            self._save_or_dead_letter(
+                records[start:start + self.config['INGEST_BATCH_SIZE']])
+        return len(records)
+
+    def _save_or_dead_letter(self, batch):
+        """Saves a batch, retrying with backoff; if it keeps failing, saves
+        its records one at a time and dead-letters those that fail."""
+        delay = self.config['INGEST_FLUSH_INTERVAL']
+        for attempt in range(self.config['INGEST_SAVE_ATTEMPTS']):
+            try:
+                self.save(batch)
+                return
+            except Exception as e:
+                app.logger.exception(e)
+            time.sleep(delay)
+            delay = min(delay * 2, self.config['INGEST_RETRY_MAX_DELAY'])
+        for record in batch:
+            try:
+                self.save([record])
+            except Exception as e:
+                app.logger.exception(e)
+                self._dead_letter(record)
+
+    def _dead_letter(self, record):
+        path = os.path.join(self.config['INGEST_LOG_DIR'],
+                            'ingest-{0}.dead'.format(os.getpid()))
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            if self.config['INGEST_LOG_FSYNC']:
+                os.fsync(f.fileno())
+        app.logger.error('Could not save {0}; appended it to {1}'.format(
+            json.dumps(record), path))
+
+    def save(self, records):
+        """Saves logged submissions in a single transaction."""
+        try:
+            for record in records:
+                created_at = datetime.strptime(record['created_at'],
+                                               INGEST_TIME_FORMAT)
+                # a text whose reply is already stored was saved before
+                answered = record['sms_sid'] and not db_session.execute(
+                    InsertIgnore(WebhookResponse.__table__),
+                    {'sms_sid': record['sms_sid'],
+                     'response': record['reply'],
+                     'created_at': created_at}).rowcount
+                if record.get('duplicate'):
+                    bump_stats(duplicates=int(not answered))
+                    continue
+                audited_at = datetime.strptime(record['audited_at'],
+                                               INGEST_TIME_FORMAT)
+                is_new, is_duplicate, phone_number_id = _submit_raffle_number(
+                    record['from'], record['raffle_number'], created_at)
+                if is_duplicate:
+                    # replayed after a crash, unless another worker saved
+                    # the same number from a different text first
+                    bump_stats(duplicates=int(bool(record['sms_sid']) and
+                                              not answered))
+                    continue
+                winner = False
+                db_session.add(Audit(
+                    _saved_audit_description(record['from'],
+                                             record['raffle_number'], is_new),
+                    audited_at, record['from'], record['raffle_number']))
+                if record['winner'] and _system_notify_raffle_winner(
+                        phone_number_id, record['raffle_number']):
+                    winner = True
+                    db_session.add(Audit(
+                        _notified_audit_description(record['from'],
+                                                    record['raffle_number']),
+                        audited_at, record['from'], record['raffle_number']))
+                bump_stats(submissions=1, phone_numbers=int(is_new),
+                           system_notifications=int(winner))
             db_session.commit()
-            return redirect(url_for('admin_view_raffle_winners'))
+        finally:
+            db_session.remove()
+
+    def _next_batch(self, timeout=None):
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.config['INGEST_FLUSH_INTERVAL']
+        while len(batch) < self.config['INGEST_BATCH_SIZE']:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        recover_at = 0
+        while True:
+            if recover_at is not None and time.time() >= recover_at:
+                try:
+                    recovered = self.recover()
+                except Exception as e:
+                    app.logger.exception(e)
+                    recovered = False
+                recover_at = None if recovered else \
+                    time.time() + self.config['INGEST_RECOVERY_INTERVAL']
+            batch = self._next_batch(
+                None if recover_at is None else
+                max(0, recover_at - time.time()))
+            if not batch:
+                continue
+            self._save_or_dead_letter(batch)
+            logged = [record for record in batch
+                      if not record.get('duplicate')]
+            with self._lock:
+                for record in logged:
+                    self._pending.discard((record['from'],
+                                           record['raffle_number']))
+                self._saved += len(logged)
+                if self._saved == self._appended:
+                    self._log.truncate(0)
+
+    def drain(self):
+        """Saves everything still queued; called at exit."""
+        if self._pid != os.getpid():
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            self.save(batch)
+
+
+INGEST_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
 
-    return render_template('admin/raffle_winners/add_raffle_winner.html', form=form)
 
+ingestion_log = IngestionLog()
+atexit.register(ingestion_log.drain)
 
-# admin edit_raffle_winner
-@app.route('/admin/raffle_winners/<int:raffle_winner_id>/edit',
-           methods=['GET', 'POST'])
-@requires_auth
-def admin_edit_raffle_winner(raffle_winner_id):
-    raffle_winner = RaffleWinner.query.get(raffle_winner_id)
-    if request.method == 'GET':
-        form = RaffleWinnerForm(obj=raffle_winner)
+
+def record_audit(description, phone_number=None, raffle_number=None):
+    """Audits an SMS submission, either in the current transaction or,
+    with AUDIT_WRITE_BEHIND, through the buffered audit writer.
+    """
+    if current_app.config['AUDIT_WRITE_BEHIND']:
+        audit_writer.add(description, phone_number, raffle_number)
     else:
-        form = RaffleWinnerForm(obj=raffle_winner)
-        if form.validate_on_submit():
-            form.populate_obj(raffle_winner)
-            raffle_winner.updated_at = datetime.utcnow()
-            db_session.add(raffle_winner)
-            db_session.commit()
-            return redirect(url_for('admin_view_raffle_winners'))
+        db_session.add(Audit(description, phone_number=phone_number,
+                             raffle_number=raffle_number))
 
-    return render_template('admin/raffle_winners/edit_raffle_winner.html',
-                           form=form, raffle_winner=raffle_winner)
 
+class AuditWriter(object):
+    """Buffers audits in memory and inserts them in batches from a
+    background thread, so they add no latency to SMS replies. Audits still
+    in the buffer are lost if the process is killed before a flush.
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, config):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = Queue.Queue()
+            self.batch_size = config['AUDIT_BATCH_SIZE']
+            self.flush_interval = config['AUDIT_FLUSH_INTERVAL']
+            thread = threading.Thread(target=self._run, name='audit-writer')
+            thread.daemon = True
+            thread.start()
+
+    def add(self, description, phone_number=None, raffle_number=None):
+        self.start(current_app.config)
+        self._queue.put({
+            'description': description,
+            'phone_number': phone_number,
+            'raffle_number': raffle_number,
+            'created_at': get_hst_time()})
+
+    def flush(self):
+        """Inserts up to a batch of buffered audits, returning how many."""
+        if self._pid != os.getpid():
+            return 0
+        audits = []
+        while len(audits) < self.batch_size:
+            try:
+                audits.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        if audits:
+            try:
+                db_session.execute(Audit.__table__.insert(), audits)
+                db_session.commit()
+            finally:
+                db_session.remove()
+        return len(audits)
+
+    def flush_all(self):
+        while self.flush():
+            pass
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush_all()
+            except Exception as e:
+                app.logger.exception(e)
+
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.flush_all)
+
+
+class RaffleWinnerImportError(Exception):
+    def __init__(self, errors):
+        super(RaffleWinnerImportError, self).__init__('; '.join(errors))
+        self.errors = errors
+
+
+RAFFLE_WINNER_IMPORT_FIELDS = ['raffle_number', 'item', 'raffle_time']
+
+
+def parse_raffle_winners(text):
+    """Parses raffle winners given either as a JSON list or as CSV lines of
+    raffle_number,item[,raffle_time] (with an optional header row).
+    """
+    text = text.strip()
+    if text.startswith('['):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise RaffleWinnerImportError(['Invalid JSON: {0}'.format(e)])
+
+    reader = csv.reader(StringIO(text.encode('utf-8')))
+    rows = [[cell.decode('utf-8') for cell in row] for row in reader if row]
+    if rows and rows[0][0].strip() == 'raffle_number':
+        rows = rows[1:]
+    return [dict(zip(RAFFLE_WINNER_IMPORT_FIELDS, row)) for row in rows]
+
+
+def import_raffle_winners(rows):
+    """Validates every row, then inserts all of the raffle winners in one
+    transaction with a single summary audit. Returns the (phone_number,
+    raffle_number) pairs already submitted for the new winning numbers.
+    Nothing is inserted if any row is invalid.
+    """
+    if not isinstance(rows, list):
+        raise RaffleWinnerImportError(['Expected a list of raffle winners'])
+
+    now = datetime.utcnow()
+    errors = []
+    winners = []
+    raffle_numbers = set()
+    # the same range RaffleWinnerForm enforces from the column info
+    raffle_time_info = RaffleWinner.__table__.c.raffle_time.info
+    earliest, latest = raffle_time_info['min'], raffle_time_info['max']
+
+    for line, row in enumerate(rows, 1):
+        if isinstance(row, (list, tuple)):
+            row = dict(zip(RAFFLE_WINNER_IMPORT_FIELDS, row))
+        if not isinstance(row, dict):
+            errors.append('Row {0}: expected an object or a list'.format(line))
+            continue
+
+        raffle_number = unicode(row.get('raffle_number') or '').strip()
+        item = unicode(row.get('item') or '').strip()
+        raffle_time = unicode(row.get('raffle_time') or '').strip()
+
+        if not raffle_number or len(raffle_number) > 8:
+            errors.append('Row {0}: invalid raffle number {1!r}'.format(line, raffle_number))
+        elif raffle_number in raffle_numbers:
+            errors.append('Row {0}: raffle number {1} is listed twice'.format(line, raffle_number))
+        if not item or len(item) > 256:
+            errors.append('Row {0}: invalid prize {1!r}'.format(line, item))
+        if raffle_time:
+            try:
+                raffle_time = datetime.strptime(raffle_time, RAFFLE_TIME_FORMAT)
+            except ValueError:
+                errors.append('Row {0}: raffle time must look like {1}'.format(
+                    line, get_hst_time().strftime(RAFFLE_TIME_FORMAT)))
+        else:
+            raffle_time = get_hst_time()
+        if isinstance(raffle_time, datetime) and \
+                not earliest <= raffle_time <= latest:
+            errors.append('Row {0}: raffle time {1} is not between {2} and '
+                          '{3}'.format(line, raffle_time.strftime(
+                              RAFFLE_TIME_FORMAT), earliest.strftime(
+                              RAFFLE_TIME_FORMAT), latest.strftime(
+                              RAFFLE_TIME_FORMAT)))
+
+        raffle_numbers.add(raffle_number)
+        winners.append({
+            'raffle_number': raffle_number,
+            'item': item,
+            'raffle_time': raffle_time,
+            'is_claimed': False,
+            'num_system_notified': 0,
+            'num_admin_notified': 0,
+            'updated_at': now,
+            'created_at': now})
+
+    if not winners and not errors:
+        errors.append('No raffle winners given')
+
+    if raffle_numbers:
+        existing = db_session.query(RaffleWinner.raffle_number).filter(
+            RaffleWinner.raffle_number.in_(raffle_numbers)).all()
+        for row in existing:
+            errors.append('Raffle number {0} has already been drawn'.format(row.raffle_number))
+
+    if errors:
+        raise RaffleWinnerImportError(errors)
+
+    db_session.execute(RaffleWinner.__table__.insert(), winners)
+    rematch_raffle_numbers(db_session, raffle_numbers)
+    db_session.execute(RaffleEvent.__table__.insert(), [
+        {'kind': 'winner_added',
+         'raffle_number': winner['raffle_number'],
+         'item': winner['item'],
+         'created_at': now} for winner in winners])
+    db_session.add(Audit("Admin has drawn numbers {0} in a batch of {1}".format(
+        ', '.join(sorted(raffle_numbers)), len(winners))[:256]))
+    bump_stats(winners=len(winners))
+    bump_raffle_winner_version()
+
+    matches = db_session.query(PhoneNumber.phone_number,
+                               WinnerMatch.raffle_number).\
+        join(WinnerMatch, WinnerMatch.phone_number_id == PhoneNumber.id).\
+        filter(WinnerMatch.raffle_number.in_(raffle_numbers)).\
+        order_by(WinnerMatch.raffle_number, PhoneNumber.phone_number).all()
 
-# admin delete_raffle_winner
-@app.route('/admin/raffle_winners/<int:raffle_winner_id>/delete',
-           methods=['POST'])
-@requires_auth
-def admin_delete_raffle_winner(raffle_winner_id):
-    raffle_winner = RaffleWinner.query.get(raffle_winner_id)
-    db_session.delete(raffle_winner)
     db_session.commit()
-    return redirect(url_for('admin_view_raffle_winners'))
+    shared_state.publish(RAFFLE_EVENTS_CHANNEL)
+    return matches
 
 
-# admin claim_raffle_winner
-@app.route('/admin/raffle_winners/claim', methods=['POST'])
-@requires_auth
-def admin_claim_raffle_winner():
-    _claim_unclaim_raffle_winner(True)
-    return redirect(url_for('admin_view_raffle_winners'))
+# admin
 
+_admin_lock = threading.Lock()
 
-# admin unclaim_raffle_winner
-@app.route('/admin/raffle_winners/unclaim', methods=['POST'])
-@requires_auth
-def admin_unclaim_raffle_winner():
-    _claim_unclaim_raffle_winner(False)
-    return redirect(url_for('admin_view_raffle_winners'))
-
-
-def _claim_unclaim_raffle_winner(claim):
-    raffle_winner_id = request.values.get('raffle_id', None)
-    if raffle_winner_id:
-        raffle_winner = RaffleWinner.query.get(raffle_winner_id)
-        if raffle_winner:
-            raffle_winner.is_claimed = claim
-            db_session.add(raffle_winner)
-            db_session.commit()
 
+def register_admin():
+    """Imports the admin blueprint (its views and forms, and with them
+    WTForms and WTForms-Alchemy) and registers it on the app.
+    """
+    with _admin_lock:
+        if 'admin' not in app.blueprints:
+            from admin import admin
+            app.register_blueprint(admin)
 
-# admin notify_raffle_winner
-@app.route('/admin/raffle_winners/notify', methods=['POST'])
-@requires_auth
-def admin_notify_raffle_winner():
-    raffle_winner_id = request.values.get('raffle_id', None)
-    if raffle_winner_id:
-        raffle_winner = RaffleWinner.query.get(raffle_winner_id)
-        winners = PhoneNumber.query.join(PhoneNumberRaffleNumber).filter(PhoneNumberRaffleNumber.raffle_number == raffle_winner.raffle_number).all()
-        if winners:
-            for winner in winners:
-                _notify_via_twilio(winner.phone_number, WINNER_COPY)
-
-                audit = Audit("Admin notified {0} that they've won a prize for claiming {1}".format(winner.phone_number, raffle_winner.raffle_number))
-                db_session.add(audit)
-
-                for raffle_number in winner.raffle_numbers:
-                    if raffle_number.raffle_number == raffle_winner.raffle_number:
-                        raffle_number.num_admin_notified += 1
-                        db_session.add(raffle_number)
-
-            raffle_winner.num_admin_notified += 1
-            db_session.add(raffle_winner)
-            db_session.commit()
-        else:
-            flash('No phone number has claimed this raffle number, so a notification at this time is unnecessary.')
-    return redirect(url_for('admin_view_raffle_winners'))
 
+class LazyAdminMiddleware(object):
+    """Registers the admin blueprint just before a worker routes its first
+    /admin request, so workers that only answer the SMS webhook start
+    without it.
+    """
 
-def _notify_via_twilio(to, message):
-    account_sid = current_app.config['TWILIO_ACCOUNT_SID']
-    auth_token = current_app.config['TWILIO_AUTH_TOKEN']
-    from_number = current_app.config['TWILIO_NUMBER']
-    client = TwilioRestClient(account_sid, auth_token)
-    client.messages.create(to=to, from_=from_number, body=message)
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._registered = False
+        self._lock = threading.Lock()
 
+    def __call__(self, environ, start_response):
+        # register_blueprint() lists the blueprint before it adds its rules,
+        # so app.blueprints cannot tell other threads registration is done
+        if not self._registered and \
+                environ.get('PATH_INFO', '').startswith('/admin'):
+            with self._lock:
+                if not self._registered:
+                    register_admin()
+                    self._registered = True
+        return self.wsgi_app(environ, start_response)
 
-# admin view_phone_numbers
-@app.route('/admin/phone_numbers', methods=['GET'])
-@requires_auth
-def admin_view_phone_numbers():
-    phone_numbers = PhoneNumber.query.all()
-    raffle_winners = RaffleWinner.query.all()
-    raffle_winners_as_dict = {}
-    for winner in raffle_winners:
-        raffle_winners_as_dict[winner.raffle_number] = winner
-    return render_template('admin/phone_numbers/view_phone_numbers.html',
-                           phone_numbers=phone_numbers,
-                           raffle_winners=raffle_winners_as_dict)
-
-
-# admin add_phone_number
-@app.route('/admin/phone_numbers/add', methods=['GET', 'POST'])
-@requires_auth
-def admin_add_phone_number():
-    form = PhoneNumberForm()
-
-    if form.validate_on_submit():
-        phone_number = PhoneNumber()
-        form.populate_obj(phone_number)
-        phone_number.updated_at = datetime.utcnow()
-        phone_number.created_at = datetime.utcnow()
-        db_session.add(phone_number)
-        db_session.commit()
-        return redirect(url_for('admin_view_phone_numbers'))
 
-    return render_template('admin/phone_numbers/add_phone_number.html', form=form)
+app.wsgi_app = LazyAdminMiddleware(app.wsgi_app)
 
 
-# admin edit_phone_number
-@app.route('/admin/phone_numbers/<int:phone_number_id>/edit',
-           methods=['GET', 'POST'])
-@requires_auth
-def admin_edit_phone_number(phone_number_id):
-    phone_number = PhoneNumber.query.get(phone_number_id)
-    if request.method == 'GET':
-        form = PhoneNumberForm(obj=phone_number)
-    else:
-        form = PhoneNumberForm(obj=phone_number)
-        if form.validate_on_submit():
-            form.populate_obj(phone_number)
-            phone_number.updated_at = datetime.utcnow()
-            db_session.add(phone_number)
-            db_session.commit()
-            return redirect(url_for('admin_view_phone_numbers'))
+def _enqueue_notification(to, message):
+    """Queues an outbound SMS; it is sent by the outbound message sender
+    once the current transaction commits.
+    """
+    now = datetime.utcnow()
+    db_session.add(OutboundMessage(to, message, created_at=now,
+                                   updated_at=now))
 
-    return render_template('admin/phone_numbers/edit_phone_number.html',
-                           form=form, phone_number=phone_number)
 
+# Outbound messages
 
-# admin delete_phone_number
-@app.route('/admin/phone_numbers/<int:phone_number_id>/delete',
-           methods=['POST'])
-@requires_auth
-def admin_delete_phone_number(phone_number_id):
-    phone_number = PhoneNumber.query.get(phone_number_id)
-    db_session.delete(phone_number)
-    db_session.commit()
-    return redirect(url_for('admin_view_phone_numbers'))
+class OutboundMessageSender(object):
+    """Sends queued OutboundMessages from a bounded pool of background
+    threads through the worker's Twilio gateway. Messages are claimed
+    with a conditional UPDATE, so several uWSGI workers can run a sender
+    against the same database without sending a message twice.
+    """
 
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def start(self, config):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.config = config
+            self.num_threads = config['OUTBOUND_SENDER_THREADS']
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self._run,
+                                          name='outbound-sender-%d' % i)
+                thread.daemon = True
+                thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                sent = self.send_next()
+            except Exception as e:
+                app.logger.exception(e)
+                sent = False
+            finally:
+                db_session.remove()
+            if not sent:
+                self._wakeup.wait(self.config['OUTBOUND_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def send_next(self):
+        """Sends the next due message. Returns False if nothing was due."""
+        message = self._claim_next()
+        if message is None:
+            return False
+
+        started = time.time()
+        try:
+            sid = get_twilio_gateway().send_sms(message.to_number,
+                                                message.body)
+        except Exception as e:
+            metrics.observe('hnlmakerfaire_twilio_request_seconds',
+                            {'operation': 'messages.create', 'outcome': 'error'},
+                            time.time() - started)
+            app.logger.exception(e)
+            message.last_error = str(e)[:256]
+            if message.attempts >= self.config['OUTBOUND_MAX_ATTEMPTS']:
+                message.status = 'failed'
+            else:
+                backoff = self.config['OUTBOUND_RETRY_BACKOFF'] * \
+                    2 ** (message.attempts - 1)
+                message.status = 'pending'
+                message.send_after = datetime.utcnow() + \
+                    timedelta(seconds=backoff)
+        else:
+            metrics.observe('hnlmakerfaire_twilio_request_seconds',
+                            {'operation': 'messages.create', 'outcome': 'ok'},
+                            time.time() - started)
+            message.status = 'sent'
+            message.sid = sid
+        message.updated_at = datetime.utcnow()
+        db_session.add(message)
+        db_session.commit()
+        return True
+
+    def _claim_next(self):
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.config['OUTBOUND_SENDING_TIMEOUT'])
+        candidates = db_session.query(
+            OutboundMessage.id,
+            OutboundMessage.status,
+            OutboundMessage.updated_at).filter(or_(
+                and_(OutboundMessage.status == 'pending',
+                     or_(OutboundMessage.send_after == None,
+                         OutboundMessage.send_after <= now)),
+                and_(OutboundMessage.status == 'sending',
+                     OutboundMessage.updated_at <= stale))).\
+            order_by(OutboundMessage.id).limit(self.num_threads).all()
+
+        for candidate in candidates:
+            claim = OutboundMessage.__table__.update().where(and_(
+                OutboundMessage.id == candidate.id,
+                OutboundMessage.status == candidate.status,
+                OutboundMessage.updated_at == candidate.updated_at)).\
+                values(status='sending',
+                       attempts=OutboundMessage.attempts + 1,
+                       updated_at=now)
+            if db_session.execute(claim).rowcount == 1:
+                db_session.commit()
+                return OutboundMessage.query.get(candidate.id)
+
+        db_session.rollback()
+        return None
+
+
+outbound_message_sender = OutboundMessageSender()
+
+
+@app.before_first_request
+def start_outbound_message_sender():
+    outbound_message_sender.start(current_app.config)
+
+
+@app.before_first_request
+def start_ingestion_log():
+    if current_app.config['INGEST_WRITE_BEHIND']:
+        ingestion_log.start(current_app.config)
+
+
+# each returns (query, created_at column, converter from UTC to the time
+# zone that column is stored in, or None for UTC)
+def _export_phone_numbers():
+    return db_session.query(
+        PhoneNumber.id,
+        PhoneNumber.phone_number,
+        PhoneNumber.created_at,
+        PhoneNumber.updated_at), PhoneNumber.created_at, None
+
+
+def _export_submissions():
+    return db_session.query(
+        PhoneNumberRaffleNumber.id,
+        PhoneNumber.phone_number,
+        PhoneNumberRaffleNumber.raffle_number,
+        PhoneNumberRaffleNumber.num_system_notified,
+        PhoneNumberRaffleNumber.num_admin_notified,
+        PhoneNumberRaffleNumber.created_at).\
+        select_from(PhoneNumberRaffleNumber).\
+        outerjoin(PhoneNumber), PhoneNumberRaffleNumber.created_at, None
+
+
+def _export_winners():
+    return db_session.query(
+        RaffleWinner.id,
+        RaffleWinner.raffle_number,
+        RaffleWinner.item,
+        RaffleWinner.raffle_time,
+        RaffleWinner.is_claimed,
+        RaffleWinner.num_system_notified,
+        RaffleWinner.num_admin_notified,
+        RaffleWinner.created_at), RaffleWinner.created_at, None
+
+
+def _export_audits():
+    return db_session.query(
+        Audit.id,
+        Audit.description,
+        Audit.phone_number,
+        Audit.raffle_number,
+        Audit.created_at), Audit.created_at, utc_to_hst
+
+
+EXPORTS = {
+    'phone_numbers': _export_phone_numbers,
+    'submissions': _export_submissions,
+    'winners': _export_winners,
+    'audits': _export_audits,
+}
+
+
+def export_rows(name, since=None, until=None):
+    """Yields the column names of an export, then each of its rows in id
+    order. Rows are fetched in chunks of EXPORT_CHUNK_SIZE, and the
+    created_at range is filtered in SQL. since and until are UTC, and are
+    converted for tables (audits) that store local time.
+    """
+    query, created_at, convert = EXPORTS[name]()
+    if convert is not None:
+        since = since and convert(since)
+        until = until and convert(until)
+    if since:
+        query = query.filter(created_at >= since)
+    if until:
+        query = query.filter(created_at < until)
+    query = query.order_by(query.column_descriptions[0]['expr']).\
+        execution_options(stream_results=True).\
+        yield_per(current_app.config['EXPORT_CHUNK_SIZE'])
 
-# admin view_phone_number_raffle_number
-@app.route('/admin/phone_number_raffle_numbers/<string:raffle_number>', methods=['GET'])
-@requires_auth
-def admin_view_phone_number_raffle_number_by_raffle_number(raffle_number):
-    phone_number_raffle_numbers = PhoneNumberRaffleNumber.query.filter(PhoneNumberRaffleNumber.raffle_number == raffle_number)
-    return render_template('admin/phone_numbers_raffle_numbers/view_phone_numbers_raffle_numbers_by_raffle_number.html',
-                           phone_number_raffle_numbers=phone_number_raffle_numbers,
-                           raffle_number=raffle_number)
+    yield [column['name'] for column in query.column_descriptions]
+    for row in query:
+        yield row
 
 
-# admin add_phone_number_raffle_number
-@app.route('/admin/phone_numbers/<int:phone_number_id>/raffle_numbers/add',
-           methods=['GET', 'POST'])
-@requires_auth
-def admin_add_phone_number_raffle_number(phone_number_id):
-    phone_number = PhoneNumber.query.get(phone_number_id)
-    form = PhoneNumberRaffleNumberForm()
-
-    if form.validate_on_submit():
-        pn_rn = PhoneNumberRaffleNumber()
-        form.populate_obj(pn_rn)
-        pn_rn.phone_number_id = phone_number_id
-        pn_rn.updated_at = datetime.utcnow()
-        pn_rn.created_at = datetime.utcnow()
-        db_session.add(pn_rn)
-        db_session.commit()
-        return redirect(url_for('admin_view_phone_numbers'))
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(RAFFLE_TIME_FORMAT)
+    return value
 
-    return render_template('admin/phone_numbers/add_raffle_number.html',
-            form=form, phone_number=phone_number)
 
+def serialize_csv(rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([unicode(value).encode('utf-8') if value is not None else ''
+                         for value in map(_export_value, row)])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
 
-# admin delete_phone_number_raffle_number
-@app.route('/admin/phone_numbers/<int:phone_number_id>/raffle_numbers/<int:phone_number_raffle_number_id>/delete',
-           methods=['POST'])
-@requires_auth
-def admin_delete_phone_number_raffle_number(phone_number_id, phone_number_raffle_number_id):
-    phone_number_raffle_number = PhoneNumberRaffleNumber.query.get(phone_number_raffle_number_id)
-    phone_number_id = phone_number_raffle_number.phone_number.id
-    db_session.delete(phone_number_raffle_number)
-    db_session.commit()
-    return redirect(url_for('admin_edit_phone_number',
-        phone_number_id=phone_number_id))
 
+def serialize_jsonl(rows):
+    rows = iter(rows)
+    names = next(rows)
+    for row in rows:
+        yield json.dumps(dict(zip(names, map(_export_value, row)))) + '\n'
 
-# admin view_audits
-@app.route('/admin/audits', methods=['GET'])
-@requires_auth
-def admin_view_audits():
-    audits = Audit.query.order_by(Audit.created_at.desc())
-    return render_template('admin/audits/view_audits.html',
-                           audits=audits)
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', serialize_csv),
+    'jsonl': ('application/x-ndjson', serialize_jsonl),
+}
 
 
 # default view
 @app.route('/', methods=['GET'])
 def show_raffle_numbers():
+    version, updated_at = get_raffle_winner_version_stamp()
+
+    # flashed messages are per user, so never serve or cache them
+    if '_flashes' in session:
+        body = _render_raffle_numbers()
+    else:
+        body = raffle_numbers_page_cache.get(version, _render_raffle_numbers)
+
+    response = Response(body, mimetype='text/html')
+    # a deploy changes the fingerprinted asset links in the page too
+    static_manifest.load()
+    response.set_etag('winners-{0}-{1}'.format(version,
+                                               static_manifest.build_id))
+    response.last_modified = max(updated_at or static_manifest.built_at,
+                                 static_manifest.built_at or updated_at)
+    response.cache_control.max_age = 0
+    response.cache_control.must_revalidate = True
+    return response.make_conditional(request)
+
+
+def _render_raffle_numbers():
     unclaimed_raffle_winners = RaffleWinner.\
         query.filter(RaffleWinner.is_claimed == False)
     claimed_raffle_winners = RaffleWinner.\
@@ -563,6 +2107,365 @@ def show_raffle_numbers():
                            claimed_raffle_winners=claimed_raffle_winners)
 
 
+class VersionedPageCache(object):
+    """Holds the last page rendered for a raffle winner version; any change
+    to the raffle winners bumps the version and so invalidates it.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.body = None
+        self._lock = threading.Lock()
+
+    def get(self, version, render):
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.body = render()
+                    self.version = version
+        return self.body
+
+
+raffle_numbers_page_cache = VersionedPageCache()
+
+
+# raffle event stream
+@app.route('/events', methods=['GET'])
+def stream_raffle_events():
+    if not current_app.config['LIVE_EVENTS_ENABLED']:
+        abort(404)
+    last_event_id = request.headers.get('Last-Event-ID', None, type=int)
+    subscriber, backlog = raffle_event_broadcaster.subscribe(last_event_id)
+    keepalive = current_app.config['EVENT_KEEPALIVE_INTERVAL']
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            for message in backlog:
+                yield message
+            while True:
+                try:
+                    yield subscriber.get(timeout=keepalive)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            raffle_event_broadcaster.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+class RaffleEventBroadcaster(object):
+    """Fans RaffleEvents out to every event stream connected to this
+    process. A single thread per process polls the RaffleEvent table, so
+    the database cost does not grow with the number of subscribers, and
+    events written by any worker reach every subscriber.
+    """
+
+    def __init__(self):
+        self.last_id = None
+        self.subscribers = set()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def start(self, config):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.subscribers = set()
+            self.poll_interval = config['EVENT_POLL_INTERVAL']
+            self.last_id = db_session.query(
+                func.max(RaffleEvent.id)).scalar() or 0
+            shared_state.subscribe(RAFFLE_EVENTS_CHANNEL,
+                                   lambda message: self.wake())
+            thread = threading.Thread(target=self._run,
+                                      name='raffle-event-broadcaster')
+            thread.daemon = True
+            thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def subscribe(self, last_event_id=None):
+        """Returns a queue of serialized events for a new subscriber, and
+        the events after last_event_id that it has missed.
+        """
+        self.start(current_app.config)
+        subscriber = Queue.Queue()
+        with self._lock:
+            self.subscribers.add(subscriber)
+            last_id = self.last_id
+        backlog = []
+        if last_event_id is not None:
+            backlog = [raffle_event.to_sse()
+                       for raffle_event in RaffleEvent.query.filter(
+                           and_(RaffleEvent.id > last_event_id,
+                                RaffleEvent.id <= last_id)).order_by(
+                                    RaffleEvent.id)]
+        return subscriber, backlog
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def publish_pending(self):
+        raffle_events = RaffleEvent.query.filter(
+            RaffleEvent.id > self.last_id).order_by(RaffleEvent.id).all()
+        with self._lock:
+            for raffle_event in raffle_events:
+                message = raffle_event.to_sse()
+                for subscriber in self.subscribers:
+                    subscriber.put(message)
+                self.last_id = raffle_event.id
+
+    def _run(self):
+        while True:
+            try:
+                self.publish_pending()
+            except Exception as e:
+                app.logger.exception(e)
+            finally:
+                db_session.remove()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+raffle_event_broadcaster = RaffleEventBroadcaster()
+
+
+# Metrics
+
+class Metrics(object):
+    """Per-process counters and histograms. Each process writes its own
+    snapshot to METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds,
+    without any locking between workers, and collect() sums the snapshots
+    of the uWSGI workers still running. Snapshots of workers that have
+    exited are removed, so a restarted worker resets its counters (which
+    Prometheus' rate() expects) rather than leaving them summed forever.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+               5.0, 10.0)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._pid = os.getpid()
+        self._last_flush = 0
+        self._lock = threading.Lock()
+
+    def _reset_after_fork(self):
+        if self._pid != os.getpid():
+            self.counters = {}
+            self.histograms = {}
+            self._pid = os.getpid()
+            self._last_flush = 0
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._reset_after_fork()
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._reset_after_fork()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.BUCKETS, value)
+            if index < len(self.BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def _path(self, pid):
+        return os.path.join(app.config['METRICS_DIR'],
+                            'metrics-{0}.json'.format(pid))
+
+    def flush(self, force=False):
+        now = time.time()
+        if not force and \
+                now - self._last_flush < app.config['METRICS_FLUSH_INTERVAL']:
+            return
+        with self._lock:
+            self._reset_after_fork()
+            self._last_flush = now
+            snapshot = json.dumps({
+                'counters': [[name, dict(labels), value] for
+                             (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), histogram] for
+                               (name, labels), histogram in
+                               self.histograms.items()]})
+        if not os.path.isdir(app.config['METRICS_DIR']):
+            os.makedirs(app.config['METRICS_DIR'])
+        path = self._path(self._pid)
+        with open(path + '.tmp', 'w') as f:
+            f.write(snapshot)
+        os.rename(path + '.tmp', path)
+
+    def collect(self):
+        """Returns (counters, histograms) summed over every process."""
+        self.flush(force=True)
+        counters = {}
+        histograms = {}
+        for path in glob.glob(os.path.join(app.config['METRICS_DIR'],
+                                           'metrics-*.json')):
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+            if not _is_running(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # another worker removed it first
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                continue
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, histogram in snapshot['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                total = histograms.setdefault(key, {
+                    'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+                for i, count in enumerate(histogram['buckets']):
+                    total['buckets'][i] += count
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+        return counters, histograms
+
+    def render_prometheus(self):
+        counters, histograms = self.collect()
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0}{1} {2}'.format(name, _prometheus_labels(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {0} histogram'.format(name))
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _prometheus_labels(labels + (('le', repr(bound)),)),
+                    cumulative))
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, _prometheus_labels(labels + (('le', '+Inf'),)),
+                histogram['count']))
+            lines.append('{0}_sum{1} {2!r}'.format(
+                name, _prometheus_labels(labels), histogram['sum']))
+            lines.append('{0}_count{1} {2}'.format(
+                name, _prometheus_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        key, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels) + '}'
+
+
+metrics = Metrics()
+
+# SQL stats for the request (or background job) running on this thread
+sql_stats = threading.local()
+
+
+def _reset_sql_stats():
+    sql_stats.queries = 0
+    sql_stats.db_seconds = 0.0
+    sql_stats.commits = 0
+    sql_stats.statements = []
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.time())
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.time() - conn.info['query_started'].pop()
+    if getattr(sql_stats, 'statements', None) is None:
+        return
+    sql_stats.queries += 1
+    sql_stats.db_seconds += elapsed
+    if len(sql_stats.statements) < 50:
+        sql_stats.statements.append('{0:.1f}ms {1}'.format(
+            elapsed * 1000, ' '.join(statement.split())[:300]))
+
+
+@event.listens_for(engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute does not run for a failed statement
+    if context.connection is not None and \
+            context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+@event.listens_for(engine, 'commit')
+def _commit(conn):
+    if getattr(sql_stats, 'statements', None) is not None:
+        sql_stats.commits += 1
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.time()
+    _reset_sql_stats()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if not hasattr(g, 'request_started'):
+        return response
+    elapsed = time.time() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+    labels = {'endpoint': endpoint}
+
+    metrics.inc('hnlmakerfaire_requests_total',
+                {'endpoint': endpoint, 'status': response.status_code})
+    metrics.observe('hnlmakerfaire_request_seconds', labels, elapsed)
+    metrics.observe('hnlmakerfaire_db_seconds', labels, sql_stats.db_seconds)
+    metrics.inc('hnlmakerfaire_db_queries_total', labels, sql_stats.queries)
+    metrics.inc('hnlmakerfaire_db_commits_total', labels, sql_stats.commits)
+
+    if elapsed >= current_app.config['SLOW_REQUEST_THRESHOLD']:
+        current_app.logger.warning(
+            'Slow request {0} {1} ({2}) took {3:.1f}ms, {4} queries in '
+            '{5:.1f}ms:\n{6}'.format(
+                request.method, request.path, endpoint, elapsed * 1000,
+                sql_stats.queries, sql_stats.db_seconds * 1000,
+                '\n'.join(sql_stats.statements)))
+
+    sql_stats.statements = None
+    metrics.flush()
+    return response
+
+
+# admin metrics
+@app.route('/admin/metrics', methods=['GET'])
+@requires_auth
+def admin_metrics():
+    return Response(metrics.render_prometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 # 500
 @app.errorhandler(500)
 def internal_error(exception):
@@ -577,40 +2480,136 @@ def shutdown_session(exception=None):
 
 
 def init_db():
-    Base.metadata.create_all(engine)
-
+    migrate_db()
+    if not RaffleWinnerVersion.query.get(1):
+        db_session.add(RaffleWinnerVersion(0, datetime.utcnow()))
+        db_session.commit()
+    for shard in range(app.config['STATS_SHARDS']):
+        _seed_stats(shard, [STATS_EPOCH])
+    db_session.commit()
 
-# forms
-class RaffleWinnerForm(ModelForm):
-    class Meta:
-        model = RaffleWinner
-        include_primary_key = True
-        only = ['raffle_time', 'raffle_number', 'item']
 
+# migrations
+class SchemaVersion(Base):
+    __tablename__ = 'SchemaVersion'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
 
-class PhoneNumberRaffleNumberForm(ModelForm):
-    class Meta:
-        model = PhoneNumberRaffleNumber
-        only = ['raffle_number']
+    def __init__(self, version=0, updated_at=None):
+        self.version = version
+        self.updated_at = updated_at
 
+    def __repr__(self):
+        return '<Schema Version %r>' % (self.version)
+
+
+# Each migration is (version, [statements]) and is applied once, in order,
+# to databases created before it.  create_all() only adds missing tables,
+# so changes to existing tables (columns, indexes) belong here as well as
+# on the models.
+MIGRATIONS = [
+    (1, [
+        'CREATE INDEX IF NOT EXISTS "ix_PhoneNumberRaffleNumber_phone_number_id" '
+        'ON "PhoneNumberRaffleNumber" (phone_number_id)',
+        'CREATE INDEX IF NOT EXISTS "ix_RaffleWinner_is_claimed" '
+        'ON "RaffleWinner" (is_claimed)',
+        'CREATE INDEX IF NOT EXISTS "ix_Audit_created_at" '
+        'ON "Audit" (created_at)',
+    ]),
+    (2, [
+        'ALTER TABLE "Audit" ADD COLUMN phone_number VARCHAR(32)',
+        'ALTER TABLE "Audit" ADD COLUMN raffle_number VARCHAR(8)',
+        'CREATE INDEX IF NOT EXISTS "ix_Audit_phone_number_created_at" '
+        'ON "Audit" (phone_number, created_at)',
+        'CREATE INDEX IF NOT EXISTS "ix_Audit_raffle_number_created_at" '
+        'ON "Audit" (raffle_number, created_at)',
+    ]),
+    (3, [
+        # create_all() has created the empty WinnerMatch table
+        'INSERT INTO "WinnerMatch" (raffle_winner_id, '
+        'phone_number_raffle_number_id, phone_number_id, raffle_number) '
+        'SELECT w.id, p.id, p.phone_number_id, p.raffle_number '
+        'FROM "PhoneNumberRaffleNumber" p '
+        'JOIN "RaffleWinner" w ON w.raffle_number = p.raffle_number '
+        'WHERE p.phone_number_id IS NOT NULL',
+    ]),
+    (4, [
+        # create_all() has created the empty StatCounter table; start the
+        # running totals (shard 0) from the tables. Duplicates were never
+        # recorded.
+        'INSERT INTO "StatCounter" (minute, name, shard, value) '
+        'SELECT \'1970-01-01 00:00:00.000000\', \'submissions\', 0, COUNT(*) '
+        'FROM "PhoneNumberRaffleNumber"',
+        'INSERT INTO "StatCounter" (minute, name, shard, value) '
+        'SELECT \'1970-01-01 00:00:00.000000\', \'phone_numbers\', 0, COUNT(*) '
+        'FROM "PhoneNumber"',
+        'INSERT INTO "StatCounter" (minute, name, shard, value) '
+        'SELECT \'1970-01-01 00:00:00.000000\', \'system_notifications\', 0, '
+        'COALESCE(SUM(num_system_notified), 0) FROM "PhoneNumberRaffleNumber"',
+        'INSERT INTO "StatCounter" (minute, name, shard, value) '
+        'SELECT \'1970-01-01 00:00:00.000000\', \'admin_notifications\', 0, '
+        'COALESCE(SUM(num_admin_notified), 0) FROM "PhoneNumberRaffleNumber"',
+        'INSERT INTO "StatCounter" (minute, name, shard, value) '
+        'SELECT \'1970-01-01 00:00:00.000000\', \'winners\', 0, COUNT(*) '
+        'FROM "RaffleWinner"',
+        'INSERT INTO "StatCounter" (minute, name, shard, value) '
+        'SELECT \'1970-01-01 00:00:00.000000\', \'claimed\', 0, COUNT(*) '
+        'FROM "RaffleWinner" WHERE is_claimed',
+    ]),
+]
+
+
+def get_schema_version():
+    version = db_session.query(SchemaVersion.version).filter(
+        SchemaVersion.id == 1).scalar()
+    return version or 0
+
+
+def migrate_db():
+    """Creates missing tables and applies pending migrations in place, so
+    it can be run against a live event database.
+    """
+    is_new_database = not engine.has_table(PhoneNumber.__tablename__)
+    Base.metadata.create_all(engine)
+    if is_new_database:
+        # create_all() has already built the latest schema
+        _stamp_schema_version(MIGRATIONS[-1][0])
+        db_session.commit()
+        return
+
+    version = get_schema_version()
+    for migration_version, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        for statement in statements:
+            db_session.execute(statement)
+        _stamp_schema_version(migration_version)
+        db_session.commit()
+        app.logger.info(
+            'Migrated database to version {0}'.format(migration_version))
 
-class PhoneNumberForm(ModelForm):
-    class Meta:
-        model = PhoneNumber
-        include_primary_key = True
-        only = ['phone_number']
 
-    raffle_numbers = ModelFieldList(FormField(PhoneNumberRaffleNumberForm), min_entries=1)
+def _stamp_schema_version(version):
+    schema_version = SchemaVersion.query.get(1) or SchemaVersion()
+    schema_version.id = 1
+    schema_version.version = version
+    schema_version.updated_at = datetime.utcnow()
+    db_session.add(schema_version)
 
 
 def validate_twilio_request():
     """Ensure a request is coming from Twilio by checking the signature."""
-    validator = RequestValidator(current_app.config['TWILIO_AUTH_TOKEN'])
     if 'X-Twilio-Signature' not in request.headers:
         return False
     signature = request.headers['X-Twilio-Signature']
-    if 'SmsSid' in request.form:
-        url = url_for('check_raffle', _external=True)
-    else:
+    if 'SmsSid' not in request.form:
         return False
-    return validator.validate(url, request.form, signature.encode('UTF-8'))
+    gateway = get_twilio_gateway()
+    return gateway.validate(gateway.validation_url(), request.form,
+                            signature.encode('UTF-8'))
+
+
+if app.debug:
+    # in debug mode Flask refuses to add routes once it has served a request
+    register_admin()
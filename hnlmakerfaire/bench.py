@@ -0,0 +1,950 @@
+"""Load test and benchmark harness for the SMS webhook and the admin pages.
+
+Runs against a throwaway SQLite database (or a scratch database given by
+--database-url, whose tables are dropped first) through the Flask test
+client, or against a running uWSGI instance with --url, replaying signed
+Twilio requests:
+
+    python bench.py
+    python bench.py --submissions 5000 --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json
+    python bench.py --url http://192.168.51.51 --auth-token <token>
+    python bench.py --url http://192.168.51.51:8000 --auth-token <token> \
+        --only webhook_concurrent --concurrency 1000
+    python bench.py --micro --only twilio_validate --only twilio_send
+    python bench.py --only startup --startup-runs 20
+    python bench.py --database-url postgresql://bench@localhost/bench_scratch
+
+Each scenario reports p50/p99 latency, throughput and (in process only)
+SQL statements per request.
+"""
+import argparse
+import BaseHTTPServer
+import base64
+import datetime
+import httplib
+import json
+import multiprocessing
+import os
+import Queue
+import random
+import sys
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+
+
+AUTH_TOKEN = 'bench-auth-token'
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def configure_environment(database, database_url=None):
+    """Points the app at a throwaway database; must run before importing
+    app, which reads its settings at import time.
+    """
+    os.environ['HNLMAKERFAIRE_DATABASE'] = database
+    if database_url:
+        os.environ['HNLMAKERFAIRE_DATABASE_URL'] = database_url
+    os.environ['HNLMAKERFAIRE_METRICS_DIR'] = os.path.join(
+        os.path.dirname(database), 'metrics')
+    os.environ['HNLMAKERFAIRE_ENVIRONMENT'] = 'Benchmark'
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', AUTH_TOKEN)
+    os.environ.setdefault('TWILIO_ACCOUNT_SID', 'ACbench')
+    os.environ.setdefault('TWILIO_NUMBER', '+18085550100')
+    os.environ['HNLMAKERFAIRE_USERNAME'] = USERNAME
+    os.environ['HNLMAKERFAIRE_PASSWORD'] = PASSWORD
+    os.environ['HNLMAKERFAIRE_OUTBOUND_SENDER_THREADS'] = '0'
+    # bursts resend from the same phones; webhook_flood turns it back on
+    os.environ['HNLMAKERFAIRE_RATE_LIMIT_ENABLED'] = 'false'
+    os.environ['HNLMAKERFAIRE_RATE_LIMIT_FILE'] = os.path.join(
+        os.path.dirname(database), 'rate_limits')
+
+
+# Clients
+
+class LocalClient(object):
+    """Flask test client that also counts the SQL statements it causes."""
+
+    def __init__(self, app_module):
+        from sqlalchemy import event
+        self.app_module = app_module
+        self.client = app_module.app.test_client()
+        self.base_url = 'http://localhost'
+        self.statements = 0
+        event.listen(app_module.engine, 'before_cursor_execute',
+                     self._count_statement)
+
+    def _count_statement(self, *args):
+        self.statements += 1
+
+    def get(self, path, headers=None):
+        response = self.client.get(path, headers=headers)
+        return response.status_code, response.data
+
+    def post(self, path, data, headers=None):
+        response = self.client.post(path, data=data, headers=headers)
+        return response.status_code, response.data
+
+
+class RemoteClient(object):
+    """Plain HTTP client for benchmarking a deployed uWSGI instance."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.statements = None
+
+    def _open(self, request):
+        try:
+            response = urllib2.urlopen(request)
+            return response.getcode(), response.read()
+        except urllib2.HTTPError as e:
+            return e.code, e.read()
+
+    def get(self, path, headers=None):
+        return self._open(urllib2.Request(self.base_url + path,
+                                          headers=headers or {}))
+
+    def post(self, path, data, headers=None):
+        return self._open(urllib2.Request(self.base_url + path,
+                                          urllib.urlencode(data),
+                                          headers=headers or {}))
+
+
+def admin_headers():
+    return {'Authorization': 'Basic ' + base64.b64encode(
+        '{0}:{1}'.format(USERNAME, PASSWORD))}
+
+
+def sign_sms(client, validator, sms_sid, sms_from, body):
+    data = {'SmsSid': sms_sid, 'From': sms_from, 'Body': body}
+    signature = validator.compute_signature(
+        client.base_url + '/raffle_check', data)
+    return data, {'X-Twilio-Signature': signature}
+
+
+# Workloads
+
+def sms_burst(count, winning_numbers, seed=0, phone_prefix='+1808555'):
+    """Builds a realistic burst of (From, Body) texts: mostly new phones,
+    repeat phones sending another ticket, duplicate tickets, winners and the
+    occasional invalid message.
+    """
+    rand = random.Random(seed)
+    submitted = []
+    burst = []
+    for i in range(count):
+        roll = rand.random()
+        if submitted and roll < 0.10:
+            burst.append(rand.choice(submitted))
+            continue
+        if roll < 0.13:
+            burst.append(('{0}{1:04d}'.format(phone_prefix, i), 'hello?'))
+            continue
+        if submitted and roll < 0.40:
+            sms_from = rand.choice(submitted)[0]
+        else:
+            sms_from = '{0}{1:04d}'.format(phone_prefix, i)
+        if winning_numbers and roll > 0.95:
+            body = rand.choice(winning_numbers)
+        else:
+            body = str(rand.randint(1, 9999))
+        submitted.append((sms_from, body))
+        burst.append((sms_from, body))
+    return burst
+
+
+def expected_submissions(burst):
+    return len(set((sms_from, body) for sms_from, body in burst
+                   if body.isdigit()))
+
+
+# Measurement
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(client, requests, concurrency=1):
+    """Runs (method, path, data, headers) requests, concurrency at a time,
+    and summarizes them.
+    """
+    latencies = []
+    failed = []
+    statements = client.statements
+    pending = Queue.Queue()
+    for request in requests:
+        pending.put(request)
+
+    def run():
+        while True:
+            try:
+                method, path, data, headers = pending.get_nowait()
+            except Queue.Empty:
+                return
+            request_started = time.time()
+            try:
+                if method == 'POST':
+                    status, body = client.post(path, data, headers)
+                else:
+                    status, body = client.get(path, headers)
+            except (IOError, httplib.HTTPException):
+                status = 599
+            latencies.append(time.time() - request_started)
+            if status >= 400:
+                failed.append(status)
+
+    started = time.time()
+    if concurrency == 1:
+        run()
+    else:
+        threading.stack_size(256 * 1024)
+        threads = [threading.Thread(target=run) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.time() - started
+
+    result = {
+        'requests': len(latencies),
+        'errors': len(failed),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+    }
+    if client.statements is not None:
+        result['statements'] = round(
+            (client.statements - statements) / float(len(latencies)), 2)
+    return result
+
+
+# Scenarios
+
+def webhook_requests(client, validator, options, sms_sid_prefix,
+                     phone_prefix='+1808555'):
+    burst = sms_burst(options.submissions, options.winning_numbers,
+                      phone_prefix=phone_prefix)
+    requests = []
+    for i, (sms_from, body) in enumerate(burst):
+        data, headers = sign_sms(client, validator,
+                                 '{0}{1}'.format(sms_sid_prefix, i),
+                                 sms_from, body)
+        requests.append(('POST', '/raffle_check', data, headers))
+    return requests
+
+
+def bench_webhook(client, validator, options):
+    return measure(client, webhook_requests(client, validator, options,
+                                            'SMbench'))
+
+
+def bench_webhook_concurrent(client, validator, options):
+    """The webhook with --concurrency connections open at once, to compare
+    a uWSGI deployment with gevent_server.py."""
+    return measure(client, webhook_requests(client, validator, options,
+                                            'SMconc', phone_prefix='+1808556'),
+                   concurrency=options.concurrency)
+
+
+def bench_webhook_flood(client, validator, options):
+    """One phone texting guesses as fast as it can; all but the first
+    RATE_LIMIT_BURST are shed without touching the database. In process,
+    the rate limit is turned on for the duration."""
+    app_config = getattr(getattr(client, 'app_module', None), 'app', None)
+    if app_config is not None:
+        app_config = app_config.config
+        app_config['RATE_LIMIT_ENABLED'] = True
+    requests = []
+    for i in range(options.page_requests):
+        data, headers = sign_sms(client, validator, 'SMflood{0}'.format(i),
+                                 '+18085570000', str(i + 1))
+        requests.append(('POST', '/raffle_check', data, headers))
+    try:
+        return measure(client, requests)
+    finally:
+        if app_config is not None:
+            app_config['RATE_LIMIT_ENABLED'] = False
+
+
+def bench_public_page(client, validator, options):
+    return measure(client, [('GET', '/', None, None)] * options.page_requests)
+
+
+def bench_admin_phone_numbers(client, validator, options):
+    """The first page of phone numbers; bench_admin_phone_number_pages
+    checks that pages stay flat as the table grows."""
+    return measure(client, [('GET', '/admin/phone_numbers', None,
+                             admin_headers())] * options.page_requests)
+
+
+def bench_admin_audits(client, validator, options):
+    return measure(client, [('GET', '/admin/audits', None,
+                             admin_headers())] * options.page_requests)
+
+
+def bench_admin_winner_matches(client, validator, options):
+    """The phone numbers that submitted each winning number, read from
+    WinnerMatch; run with --submissions 100000 to check it stays flat."""
+    return measure(client, [
+        ('GET', '/admin/phone_number_raffle_numbers/{0}'.format(
+            options.winning_numbers[i % len(options.winning_numbers)]),
+         None, admin_headers())
+        for i in range(options.page_requests)])
+
+
+def bench_admin_stats(client, validator, options):
+    """The stats dashboard reads counters, so it should not slow down as
+    submissions grow."""
+    return measure(client, [('GET', '/admin/stats', None,
+                             admin_headers())] * options.page_requests)
+
+
+SCENARIOS = [
+    ('webhook', bench_webhook),
+    ('webhook_flood', bench_webhook_flood),
+    ('public_page', bench_public_page),
+    ('admin_phone_numbers', bench_admin_phone_numbers),
+    ('admin_audits', bench_admin_audits),
+    ('admin_winner_matches', bench_admin_winner_matches),
+    ('admin_stats', bench_admin_stats),
+]
+
+# Only meaningful against a running server (--url)
+REMOTE_SCENARIOS = [
+    ('webhook_concurrent', bench_webhook_concurrent),
+]
+
+
+def bench_admin_phone_number_pages(app_module, options):
+    """Grows the PhoneNumber table to each of --phone-number-sizes rows
+    and times the first and the last page of /admin/phone_numbers. Pages
+    are read by id, so latency and statements should stay flat. Returns
+    (results, ok); fails if the statements per page grow or the last
+    page's p50 more than triples."""
+    app = app_module
+    client = LocalClient(app)
+    results = []
+    seeded = 0
+    for size in options.phone_number_sizes:
+        app.db_session.remove()
+        existing = app.PhoneNumber.query.count()
+        if size > existing:
+            now = datetime.datetime.utcnow()
+            app.db_session.execute(app.PhoneNumber.__table__.insert(), [
+                {'phone_number': '+1807{0:07d}'.format(seeded + i),
+                 'created_at': now, 'updated_at': now}
+                for i in xrange(size - existing)])
+            app.bump_stats(phone_numbers=size - existing)
+            app.db_session.commit()
+            seeded += size - existing
+        last = app.db_session.query(app.func.max(app.PhoneNumber.id)).scalar()
+        app.db_session.remove()
+        for page, after in (('first', 0), ('last', last - 1)):
+            results.append(('admin_phone_numbers_{0}@{1}'.format(page, size),
+                            measure(client, [(
+                                'GET', '/admin/phone_numbers?after={0}'.format(
+                                    after), None, admin_headers())] *
+                                options.page_requests)))
+
+    ok = True
+    for page in ('first', 'last'):
+        sized = [result for name, result in results
+                 if name.startswith('admin_phone_numbers_{0}@'.format(page))]
+        flat = len(set(result['statements'] for result in sized)) == 1 and \
+            sized[-1]['p50_ms'] <= 3 * sized[0]['p50_ms'] + 1
+        ok = ok and flat
+        print('admin phone number pages: {0} page at {1} rows: {2} -> '
+              '{3}'.format(page, ', '.join(
+                  str(size) for size in options.phone_number_sizes),
+                  ', '.join('{0}ms/{1} statements'.format(
+                      result['p50_ms'], result['statements'])
+                      for result in sized), 'ok' if flat else 'FAIL'))
+    return results, ok
+
+
+# Micro benchmarks
+
+def measure_calls(func, count):
+    """Times count calls of func, summarized like measure()."""
+    latencies = []
+    started = time.time()
+    for i in xrange(count):
+        call_started = time.time()
+        func()
+        latencies.append(time.time() - call_started)
+    elapsed = time.time() - started
+    return {
+        'requests': count,
+        'errors': 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'rps': round(count / elapsed, 1),
+    }
+
+
+class StubTwilioHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every POST like Twilio's Messages endpoint, with
+    keep-alive."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'sid': 'SMstub', 'status': 'queued'})
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubTwilioServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_twilio():
+    server = StubTwilioServer(('127.0.0.1', 0), StubTwilioHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_port)
+
+
+def micro_twilio_validate(app_module, options):
+    """Webhook signature validation: a RequestValidator and url_for per
+    request (as before) against the cached gateway."""
+    from twilio.util import RequestValidator
+    token = os.environ['TWILIO_AUTH_TOKEN']
+    data = {'SmsSid': 'SMmicro', 'From': '+18085550000', 'Body': '1234'}
+    signature = RequestValidator(token).compute_signature(
+        'http://localhost/raffle_check', data)
+
+    with app_module.app.test_request_context('/raffle_check', method='POST',
+                                             data=data):
+        form = app_module.request.form
+
+        def per_request():
+            validator = RequestValidator(token)
+            url = app_module.url_for('check_raffle', _external=True)
+            assert validator.validate(url, form, signature)
+
+        def gateway():
+            twilio = app_module.get_twilio_gateway()
+            assert twilio.validate(twilio.validation_url(), form, signature)
+
+        return [
+            ('twilio_validate_per_request',
+             measure_calls(per_request, options.micro_iterations)),
+            ('twilio_validate_gateway',
+             measure_calls(gateway, options.micro_iterations)),
+        ]
+
+
+def micro_twilio_send(app_module, options):
+    """Outbound send overhead against a local stub of the Twilio API: a
+    TwilioRestClient per message (as before) against the keep-alive
+    gateway."""
+    from twilio.rest import TwilioRestClient
+    server, api_base = start_stub_twilio()
+    count = max(1, options.micro_iterations // 10)
+    try:
+        def rest_client():
+            TwilioRestClient('ACbench', 'token', base=api_base).messages.create(
+                to='+18085550000', from_='+18085550100', body='bench')
+
+        gateway = app_module.TwilioGateway('ACbench', 'token', '+18085550100',
+                                           api_base)
+
+        def keep_alive():
+            gateway.send_sms(u'+18085550000', u'bench')
+
+        return [
+            ('twilio_send_rest_client', measure_calls(rest_client, count)),
+            ('twilio_send_gateway', measure_calls(keep_alive, count)),
+        ]
+    finally:
+        server.shutdown()
+
+
+def micro_twiml_reply(app_module, options):
+    """check_raffle's parse and reply work: re.search and a TwiML tree per
+    request (as before) against a precompiled regex and reply."""
+    import re
+    from twilio import twiml
+
+    def per_request():
+        raffle_number = re.search(r'^[0-9]{1,4}$', ' 1234 '.strip()).group()
+        response = twiml.Response()
+        response.sms(app_module.LOSER_COPY)
+        return raffle_number, str(response)
+
+    def precompiled():
+        raffle_number = app_module.RAFFLE_NUMBER_RE.match(' 1234 '.strip()).group()
+        return raffle_number, app_module.LOSER_REPLY
+
+    return [
+        ('twiml_reply_per_request',
+         measure_calls(per_request, options.micro_iterations)),
+        ('twiml_reply_precompiled',
+         measure_calls(precompiled, options.micro_iterations)),
+    ]
+
+
+MICRO_BENCHMARKS = [
+    ('twiml_reply', micro_twiml_reply),
+    ('twilio_validate', micro_twilio_validate),
+    ('twilio_send', micro_twilio_send),
+]
+
+
+# Startup
+
+# Runs in a fresh interpreter, like a uWSGI worker that has just been
+# spawned: time importing app, then one signed webhook through the test
+# client.
+STARTUP_CHILD = r'''
+import time
+started = time.time()
+import app
+imported = time.time()
+import json, os, sys
+from twilio.util import RequestValidator
+data = {'SmsSid': 'SMstartup' + sys.argv[1], 'From': sys.argv[1], 'Body': '1'}
+signature = RequestValidator(os.environ['TWILIO_AUTH_TOKEN']).compute_signature(
+    'http://localhost/raffle_check', data)
+client = app.app.test_client()
+request_started = time.time()
+response = client.post('/raffle_check', data=data,
+                       headers={'X-Twilio-Signature': signature})
+finished = time.time()
+print(json.dumps({'import': imported - started,
+                  'first_request': finished - request_started,
+                  'status': response.status_code,
+                  'modules': sorted(sys.modules)}))
+'''
+
+# Only the admin blueprint should need these
+ADMIN_ONLY_MODULES = ['admin', 'flask_wtf', 'wtforms', 'wtforms_alchemy',
+                      'wtforms_components']
+
+
+def summarize_startup(latencies, errors):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'rps': round(len(latencies) / sum(latencies), 1),
+    }
+
+
+def bench_startup(options):
+    """Import time and first webhook latency of a new worker, and the
+    admin-only modules the webhook made it load."""
+    imports = []
+    first_requests = []
+    errors = 0
+    loaded = set()
+    for i in range(options.startup_runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_CHILD, '+1808558{0:04d}'.format(i)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        run = json.loads(output.strip().splitlines()[-1])
+        imports.append(run['import'])
+        first_requests.append(run['first_request'])
+        if run['status'] != 200:
+            errors += 1
+        loaded.update(module for module in run['modules']
+                      if module.split('.')[0] in ADMIN_ONLY_MODULES)
+    ok = not loaded
+    print('startup: webhook worker loaded {0} -> {1}'.format(
+        ', '.join(sorted(loaded)) or 'no admin modules',
+        'ok' if ok else 'FAIL'))
+    return [('startup_import', summarize_startup(imports, 0)),
+            ('startup_first_webhook',
+             summarize_startup(first_requests, errors))], ok
+
+
+# Checks
+
+def _parallel_writer(args):
+    database, database_url, worker, count = args
+    configure_environment(database, database_url)
+    import app as app_module
+    from twilio.util import RequestValidator
+    app_module.engine.dispose()
+    client = LocalClient(app_module)
+    validator = RequestValidator(os.environ['TWILIO_AUTH_TOKEN'])
+    burst = sms_burst(count, [], seed=worker,
+                      phone_prefix='+1808{0:03d}'.format(worker))
+    empty_replies = 0
+    for i, (sms_from, body) in enumerate(burst):
+        data, headers = sign_sms(client, validator,
+                                 'SMpar{0}x{1}'.format(worker, i),
+                                 sms_from, body)
+        status, reply = client.post('/raffle_check', data, headers)
+        if status != 200 or '<Sms></Sms>' in reply:
+            empty_replies += 1
+    return expected_submissions(burst), empty_replies
+
+
+def check_parallel_writers(app_module, database, options):
+    """Hammers the database from several processes at once and checks that
+    no submission was lost and no reply came back empty.
+    """
+    pool = multiprocessing.Pool(options.writers)
+    results = pool.map(_parallel_writer, [
+        (database, options.database_url, worker,
+         options.submissions // options.writers)
+        for worker in range(options.writers)])
+    pool.close()
+    pool.join()
+
+    app_module.db_session.remove()
+    expected = sum(submissions for submissions, _ in results)
+    saved = app_module.PhoneNumberRaffleNumber.query.filter(
+        app_module.PhoneNumberRaffleNumber.phone_number_id.in_(
+            app_module.db_session.query(app_module.PhoneNumber.id).filter(
+                app_module.PhoneNumber.phone_number.notlike('+180855%')))).count()
+    empty_replies = sum(empty for _, empty in results)
+    ok = saved == expected and empty_replies == 0
+    print('parallel writers: {0} writers, {1} expected, {2} saved, '
+          '{3} empty replies -> {4}'.format(options.writers, expected, saved,
+                                            empty_replies,
+                                            'ok' if ok else 'FAILED'))
+    return ok
+
+
+QUERY_PLANS = [
+    ('submissions by raffle number',
+     'SELECT * FROM "PhoneNumberRaffleNumber" WHERE raffle_number = ?', ['1']),
+    ('submissions by phone number',
+     'SELECT * FROM "PhoneNumberRaffleNumber" WHERE phone_number_id = ?', [1]),
+    ('winners by claim',
+     'SELECT * FROM "RaffleWinner" WHERE is_claimed = ?', [0]),
+    ('audit log',
+     'SELECT * FROM "Audit" ORDER BY created_at DESC, id DESC LIMIT 100', []),
+    ('audit log by phone number',
+     'SELECT * FROM "Audit" WHERE phone_number = ? '
+     'ORDER BY created_at DESC, id DESC LIMIT 100', ['+18085550000']),
+    ('audit log by raffle number',
+     'SELECT * FROM "Audit" WHERE raffle_number = ? '
+     'ORDER BY created_at DESC, id DESC LIMIT 100', ['1']),
+    ('matches by winner',
+     'SELECT * FROM "WinnerMatch" WHERE raffle_winner_id = ?', [1]),
+    ('matches by raffle number',
+     'SELECT * FROM "WinnerMatch" WHERE raffle_number = ?', ['1']),
+    ('matches by phone number',
+     'SELECT * FROM "WinnerMatch" WHERE phone_number_id = ?', [1]),
+    ('stats totals',
+     'SELECT name, SUM(value) FROM "StatCounter" WHERE minute = ? '
+     'GROUP BY name', ['1970-01-01 00:00:00.000000']),
+    ('stats by minute',
+     'SELECT minute, name, SUM(value) FROM "StatCounter" WHERE minute >= ? '
+     'GROUP BY minute, name', ['2015-05-15 00:00:00.000000']),
+]
+
+
+def check_winner_matches(app_module):
+    """Fails if WinnerMatch has drifted from the submissions and winners."""
+    app_module.db_session.remove()
+    missing, unexpected = app_module.check_winner_matches()
+    ok = not missing and not unexpected
+    print('winner matches: {0} missing, {1} unexpected -> {2}'.format(
+        len(missing), len(unexpected), 'ok' if ok else 'FAIL'))
+    return ok
+
+
+def check_stats(app_module):
+    """Fails if the dashboard counters disagree with the tables they count,
+    e.g. after a lost update between the parallel writers' shards."""
+    app = app_module
+    app.db_session.remove()
+    stats = app.get_stats()
+    counts = {
+        'submissions': app.PhoneNumberRaffleNumber.query.count(),
+        'phone_numbers': app.PhoneNumber.query.count(),
+        'winners': app.RaffleWinner.query.count(),
+        'claimed': app.RaffleWinner.query.filter(
+            app.RaffleWinner.is_claimed == True).count(),
+    }
+    drifted = sorted(name for name, count in counts.items()
+                     if stats[name] != count)
+    ok = not drifted
+    print('stats: {0} -> {1}'.format(
+        ', '.join('{0}={1}'.format(name, stats[name])
+                  for name in sorted(counts)),
+        'ok' if ok else 'FAIL ({0} drifted)'.format(', '.join(drifted))))
+    return ok
+
+
+def check_event_fanout(app_module, subscribers):
+    """Fails unless one RaffleEvent reaches each of the given number of
+    /events subscribers exactly once."""
+    app = app_module
+    broadcaster = app.raffle_event_broadcaster
+    with app.app.app_context():
+        queues = [broadcaster.subscribe()[0] for _ in xrange(subscribers)]
+    try:
+        app.db_session.add(app.RaffleEvent('winner_added', '0', 'Bench fanout'))
+        app.db_session.commit()
+        broadcaster.wake()
+        received = 0
+        deadline = time.time() + 5
+        for subscriber in queues:
+            try:
+                subscriber.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                continue
+            received += 1
+        time.sleep(broadcaster.poll_interval)
+        repeated = sum(not subscriber.empty() for subscriber in queues)
+    finally:
+        for subscriber in queues:
+            broadcaster.unsubscribe(subscriber)
+        app.db_session.remove()
+    ok = received == subscribers and not repeated
+    print('event fanout: {0} of {1} subscribers received the event, {2} more '
+          'than once -> {3}'.format(received, subscribers, repeated,
+                                    'ok' if ok else 'FAIL'))
+    return ok
+
+
+def check_redis_shared_state(app_module, validator):
+    """Texts and loads the public page with the shared state in fakeredis,
+    then again with that Redis down; fails on any error response, if a
+    retried text gets a different reply, or if a commit raises. Skipped
+    when fakeredis is not installed."""
+    try:
+        import fakeredis
+    except ImportError:
+        print('redis shared state: fakeredis is not installed -> skipped')
+        return True
+    app = app_module
+    server = fakeredis.FakeServer()
+    local_state = app.shared_state
+    app.shared_state = app.RedisSharedState(
+        None, 'bench:', 60, client=fakeredis.FakeStrictRedis(server=server))
+    client = LocalClient(app)
+    failures = []
+
+    def text(sms_sid, sms_from, body):
+        data, headers = sign_sms(client, validator, sms_sid, sms_from, body)
+        status, reply = client.post('/raffle_check', data, headers)
+        if status != 200 or '<Sms>' not in reply:
+            failures.append('{0} -> {1}'.format(sms_sid, status))
+        return reply
+
+    def page(label):
+        status, _ = client.get('/')
+        if status != 200:
+            failures.append('{0} / -> {1}'.format(label, status))
+
+    try:
+        reply = text('SMredis0', '+18085590000', '42')
+        page('up')
+        cached = sorted(key.decode('utf-8') for key in
+                        app.shared_state.redis.keys('bench:*'))
+        if 'bench:webhook:SMredis0' not in cached or \
+                'bench:winners:version' not in cached:
+            failures.append('nothing cached in redis: {0}'.format(cached))
+
+        server.connected = False
+        if text('SMredis0', '+18085590000', '42') != reply:
+            failures.append('SMredis0 retry got a different reply')
+        text('SMredis1', '+18085590001', '43')
+        page('down')
+        try:
+            app.bump_raffle_winner_version()
+            app.db_session.commit()
+        except Exception as e:
+            app.db_session.rollback()
+            failures.append('commit -> {0!r}'.format(e))
+        page('down after commit')
+    finally:
+        app.shared_state = local_state
+        app.db_session.remove()
+    ok = not failures
+    print('redis shared state: {0} -> {1}'.format(
+        ', '.join(failures) or 'up and down', 'ok' if ok else 'FAIL'))
+    return ok
+
+
+def check_static_assets():
+    """Fails if a template links a static file that build_static.py would
+    not fingerprint, or if static/build/ is stale."""
+    import build_static
+    errors = build_static.check()
+    for error in errors:
+        print('static assets: {0}'.format(error))
+    print('static assets: {0}'.format('FAIL' if errors else 'ok'))
+    return not errors
+
+
+def check_query_plans(app_module):
+    """Fails if any hot query has to scan a table without an index."""
+    if app_module.engine.dialect.name != 'sqlite':
+        return True
+    ok = True
+    for name, sql, params in QUERY_PLANS:
+        plan = [row['detail'] for row in app_module.engine.execute(
+            'EXPLAIN QUERY PLAN ' + sql, params)]
+        details = ' / '.join(plan)
+        full_scan = any(detail.startswith('SCAN') and 'INDEX' not in detail
+                        for detail in plan)
+        ok = ok and not full_scan
+        print('query plan: {0}: {1}{2}'.format(
+            name, details, ' <- FULL SCAN' if full_scan else ''))
+    return ok
+
+
+# Reporting
+
+def report(results, baseline, tolerance):
+    """Prints results next to the baseline. Returns False on a regression:
+    more SQL statements per request, or p99 latency beyond the tolerance.
+    """
+    ok = True
+    print('{0:<30}{1:>10}{2:>10}{3:>10}{4:>12}{5:>8}'.format(
+        'scenario', 'p50 ms', 'p99 ms', 'req/s', 'statements', 'errors'))
+    for name, result in results:
+        print('{0:<30}{1:>10}{2:>10}{3:>10}{4:>12}{5:>8}'.format(
+            name, result['p50_ms'], result['p99_ms'], result['rps'],
+            result.get('statements', '-'), result['errors']))
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        print('{0:<30}{1:>10}{2:>10}{3:>10}{4:>12}'.format(
+            '  baseline', previous['p50_ms'], previous['p99_ms'],
+            previous['rps'], previous.get('statements', '-')))
+        if result.get('statements', 0) > previous.get('statements', 0) or \
+                result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            print('{0:<30}REGRESSION'.format(''))
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='benchmark a running instance instead')
+    parser.add_argument('--auth-token', default=None,
+                        help='TWILIO_AUTH_TOKEN of the instance given by --url')
+    parser.add_argument('--submissions', type=int, default=2000)
+    parser.add_argument('--winners', type=int, default=20)
+    parser.add_argument('--page-requests', type=int, default=200)
+    parser.add_argument('--database-url',
+                        help='run in process against this scratch database '
+                             '(e.g. PostgreSQL) instead of SQLite')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='processes for the parallel writer check '
+                             '(0 to skip)')
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help='connections open at once for webhook_concurrent')
+    parser.add_argument('--phone-number-sizes', default='1000,10000,100000',
+                        help='PhoneNumber table sizes the admin phone '
+                             'number pages are timed at')
+    parser.add_argument('--event-subscribers', type=int, default=500,
+                        help='/events subscribers for the fanout check')
+    parser.add_argument('--only', action='append',
+                        help='run only the named scenario(s)')
+    parser.add_argument('--micro', action='store_true',
+                        help='also run the in-process micro benchmarks')
+    parser.add_argument('--micro-iterations', type=int, default=10000)
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='fresh interpreters for the startup benchmark')
+    parser.add_argument('--baseline', help='compare against a saved baseline')
+    parser.add_argument('--save-baseline', help='save results as a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed p99 regression against the baseline')
+    options = parser.parse_args()
+    options.phone_number_sizes = sorted(
+        int(size) for size in options.phone_number_sizes.split(','))
+
+    database = os.path.join(tempfile.mkdtemp(prefix='hnlmakerfaire-bench-'),
+                            'bench.db')
+    configure_environment(database, options.database_url)
+    if options.auth_token:
+        os.environ['TWILIO_AUTH_TOKEN'] = options.auth_token
+
+    from twilio.util import RequestValidator
+    validator = RequestValidator(os.environ['TWILIO_AUTH_TOKEN'])
+    options.winning_numbers = [str(n) for n in
+                               random.Random(1).sample(xrange(1, 10000),
+                                                       options.winners)]
+
+    app_module = None
+    if options.url:
+        client = RemoteClient(options.url)
+    else:
+        import app as app_module
+        if options.database_url:
+            app_module.Base.metadata.drop_all(app_module.engine)
+        app_module.init_db()
+        client = LocalClient(app_module)
+        client.post('/admin/raffle_winners/import', {
+            'winners': '\n'.join(
+                '{0},Bench prize {0},2015-05-15 12:00:00'.format(number)
+                for number in options.winning_numbers)},
+            admin_headers())
+
+    results = []
+    scenarios = SCENARIOS + (REMOTE_SCENARIOS if options.url else [])
+    for name, scenario in scenarios:
+        if options.only and name not in options.only:
+            continue
+        results.append((name, scenario(client, validator, options)))
+
+    ok = True
+    if app_module is not None and (not options.only or
+                                   'startup' in options.only):
+        startup_results, startup_ok = bench_startup(options)
+        results.extend(startup_results)
+        ok = startup_ok and ok
+
+    if app_module is not None and (not options.only or
+                                   'admin_phone_number_pages' in options.only):
+        page_results, pages_ok = bench_admin_phone_number_pages(app_module,
+                                                                options)
+        results.extend(page_results)
+        ok = pages_ok and ok
+
+    if options.micro and app_module is not None:
+        for name, micro_benchmark in MICRO_BENCHMARKS:
+            if options.only and name not in options.only:
+                continue
+            results.extend(micro_benchmark(app_module, options))
+
+    if app_module is not None:
+        ok = check_query_plans(app_module) and ok
+        if options.writers:
+            ok = check_parallel_writers(app_module, database, options) and ok
+        ok = check_redis_shared_state(app_module, validator) and ok
+        ok = check_winner_matches(app_module) and ok
+        ok = check_stats(app_module) and ok
+        ok = check_event_fanout(app_module, options.event_subscribers) and ok
+        ok = check_static_assets() and ok
+
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    ok = report(results, baseline, options.tolerance) and ok
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(dict(results), f, indent=2, sort_keys=True)
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""Fingerprints the files in static/ so browsers can cache them forever:
+
+    python build_static.py
+
+Each file is copied into static/build/ with a hash of its contents in its
+name (css/main.css -> build/css/main.1a2b3c4d5e.css), next to a gzip (and,
+with the brotli module installed, a brotli) variant for nginx's gzip_static
+and brotli_static.  url(...) references in CSS are rewritten to the
+fingerprinted names first, so a changed font also changes the name of the
+stylesheet that loads it.  static/build/manifest.json maps the original
+names to the fingerprinted ones for the static_url() template helper.
+Run it on every deploy, before restarting the app.  The files of the
+previous build are kept, so pages rendered (or cached) before the restart
+still load; older ones are removed.
+
+    python build_static.py --check
+
+builds into a scratch directory instead and fails if a template uses a
+static file that is not in the manifest, links a static file without
+static_url(), or if static/build/ is out of date.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+import tempfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(HERE, 'static')
+TEMPLATES_DIR = os.path.join(HERE, 'templates')
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 10
+
+# fonts like woff and woff2 are compressed already
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.ttf', '.eot', '.txt')
+
+CSS_URL_RE = re.compile(r'''url\((['"]?)([^'")?#]+)([?#][^'")]*)?\1\)''')
+STATIC_URL_RE = re.compile(r'''static_url\(\s*['"]([^'"]+)['"]\s*\)''')
+URL_FOR_STATIC_RE = re.compile(r'''url_for\(\s*['"]static['"]''')
+
+
+def source_files(static_dir):
+    """Yields the static files to fingerprint, stylesheets last so that the
+    files they reference already have their fingerprinted names.
+    """
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir:
+            dirs[:] = [name for name in dirs if name != BUILD_DIR]
+        for name in files:
+            paths.append(os.path.relpath(os.path.join(root, name),
+                                         static_dir).replace(os.sep, '/'))
+    return sorted(paths, key=lambda path: (path.endswith('.css'), path))
+
+
+def fingerprint(path, content):
+    name, extension = posixpath.splitext(path)
+    return '{0}.{1}{2}'.format(
+        name, hashlib.sha1(content).hexdigest()[:HASH_LENGTH], extension)
+
+
+def rewrite_css(path, content, manifest, errors):
+    """Points url(...) references at the fingerprinted files."""
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, reference, suffix = match.groups()
+        if reference.startswith(('/', 'data:', 'http:', 'https:')):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(directory, reference))
+        if target not in manifest:
+            errors.append('{0}: url({1}) is not a static file'.format(
+                path, reference))
+            return match.group(0)
+        return 'url({0}{1}{2}{0})'.format(
+            quote, posixpath.relpath(manifest[target], directory), suffix or '')
+
+    return CSS_URL_RE.sub(replace, content)
+
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def write_compressed(path, content):
+    """Writes the .gz and .br variants nginx serves in place of path, when
+    they are smaller."""
+    with open(path + '.gz', 'wb') as f:
+        # mtime=0 keeps rebuilds of the same file byte for byte the same
+        with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                           compresslevel=9, mtime=0) as compressed:
+            compressed.write(content)
+    if os.path.getsize(path + '.gz') >= len(content):
+        os.remove(path + '.gz')
+    if brotli is not None:
+        compressed = brotli.compress(content)
+        if len(compressed) < len(content):
+            write(path + '.br', compressed)
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def prune(output_dir, keep):
+    """Removes the files in output_dir (and their compressed variants)
+    that are not in keep."""
+    for root, dirs, files in os.walk(output_dir):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name),
+                                   output_dir).replace(os.sep, '/')
+            original, extension = posixpath.splitext(path)
+            if extension in ('.gz', '.br'):
+                path = original
+            if path not in keep:
+                os.remove(os.path.join(root, name))
+
+
+def build(static_dir, output_dir):
+    """Writes the fingerprinted files and manifest into output_dir, keeping
+    the previous build's files. Returns (manifest, errors)."""
+    manifest = {}
+    errors = []
+    previous = load_manifest(output_dir)
+    for path in source_files(static_dir):
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_css(path, content, manifest, errors)
+        manifest[path] = fingerprint(path, content)
+        output = os.path.join(output_dir, manifest[path])
+        write(output, content)
+        if path.endswith(COMPRESSIBLE):
+            write_compressed(output, content)
+    # replaced in one step, so a worker starting now never reads half of it
+    write(os.path.join(output_dir, MANIFEST + '.tmp'),
+          json.dumps(manifest, indent=2, separators=(',', ': '),
+                     sort_keys=True) + '\n')
+    os.rename(os.path.join(output_dir, MANIFEST + '.tmp'),
+              os.path.join(output_dir, MANIFEST))
+    prune(output_dir, set(manifest.values()) | set(previous.values()) |
+          set([MANIFEST]))
+    return manifest, errors
+
+
+def check_templates(templates_dir, manifest):
+    """Returns an error for every static file a template uses that is not in
+    the manifest, and for every static link that skips static_url()."""
+    errors = []
+    for root, dirs, files in os.walk(templates_dir):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            template = os.path.relpath(path, templates_dir)
+            with open(path) as f:
+                source = f.read()
+            for filename in STATIC_URL_RE.findall(source):
+                if filename not in manifest:
+                    errors.append('{0}: static_url({1!r}) is not a static '
+                                  'file'.format(template, filename))
+            if URL_FOR_STATIC_RE.search(source):
+                errors.append("{0}: use static_url() instead of "
+                              "url_for('static') so the file is "
+                              "fingerprinted".format(template))
+    return errors
+
+
+def check(static_dir=STATIC_DIR, templates_dir=TEMPLATES_DIR):
+    """Returns the ways the templates, static files and static/build/
+    disagree."""
+    scratch = tempfile.mkdtemp(prefix='hnlmakerfaire-static-')
+    try:
+        manifest, errors = build(static_dir, os.path.join(scratch, BUILD_DIR))
+    finally:
+        shutil.rmtree(scratch)
+    errors.extend(check_templates(templates_dir, manifest))
+
+    built = os.path.join(static_dir, BUILD_DIR, MANIFEST)
+    if os.path.exists(built):
+        with open(built) as f:
+            if json.load(f) != manifest:
+                errors.append('static/{0} is out of date; run python '
+                              'build_static.py'.format(BUILD_DIR))
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fingerprint and precompress the static files.')
+    parser.add_argument('--check', action='store_true',
+                        help='only check that the templates and static '
+                             'files agree')
+    args = parser.parse_args()
+
+    if args.check:
+        errors = check()
+    else:
+        manifest, errors = build(STATIC_DIR, os.path.join(STATIC_DIR, BUILD_DIR))
+        if brotli is None:
+            print 'brotli is not installed; wrote gzip variants only'
+        print 'fingerprinted {0} files into static/{1}'.format(
+            len(manifest), BUILD_DIR)
+    for error in errors:
+        print error
+    if errors:
+        sys.exit(1)
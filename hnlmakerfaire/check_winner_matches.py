@@ -0,0 +1,18 @@
+import sys
+from app import app
+from app import check_winner_matches
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] not in ([], ['--repair']):
+        sys.exit('usage: python check_winner_matches.py [--repair]')
+
+    with app.app_context():
+        missing, unexpected = check_winner_matches(repair=bool(sys.argv[1:]))
+
+    for label, matches in (('missing', missing), ('unexpected', unexpected)):
+        for raffle_winner_id, pn_rn_id, phone_number_id, raffle_number in matches:
+            print '{0}\traffle number {1}\tsubmission {2}\tphone number {3}'.format(
+                label, raffle_number, pn_rn_id, phone_number_id)
+    if (missing or unexpected) and not sys.argv[1:]:
+        sys.exit(1)
@@ -0,0 +1,29 @@
+import argparse
+import sys
+from app import app
+from app import export_rows
+from app import EXPORTS
+from app import EXPORT_FORMATS
+from app import RAFFLE_TIME_FORMAT
+from datetime import datetime
+
+
+def export_time(value):
+    return datetime.strptime(value, RAFFLE_TIME_FORMAT)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stream raffle data out as CSV or JSONL.')
+    parser.add_argument('name', choices=sorted(EXPORTS))
+    parser.add_argument('format', choices=sorted(EXPORT_FORMATS))
+    parser.add_argument('--since', type=export_time,
+                        help='only rows created at or after "YYYY-MM-DD HH:MM:SS" (UTC)')
+    parser.add_argument('--until', type=export_time,
+                        help='only rows created before "YYYY-MM-DD HH:MM:SS" (UTC)')
+    args = parser.parse_args()
+
+    mimetype, serialize = EXPORT_FORMATS[args.format]
+    with app.app_context():
+        for chunk in serialize(export_rows(args.name, args.since, args.until)):
+            sys.stdout.write(chunk)
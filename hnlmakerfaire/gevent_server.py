@@ -0,0 +1,36 @@
+"""Serves the app from a single gevent process, so the number of
+concurrent webhook and page requests is bounded by GEVENT_MAX_CONNECTIONS
+instead of by the number of uWSGI workers:
+
+    python gevent_server.py
+
+Sockets (clients, Twilio sends, Redis) are cooperative once monkey patched.
+sqlite3 calls are not, so run one gevent process per SQLite database; with
+PostgreSQL, install psycogreen to make psycopg2 cooperative too.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    pass
+
+import logging
+from logging.handlers import RotatingFileHandler
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from app import app
+
+
+if __name__ == '__main__':
+    handler = RotatingFileHandler('/var/log/flask-hnlmakerfaire.log',
+                                  maxBytes=1024*1024*5, backupCount=30)
+    handler.setLevel(logging.DEBUG)
+    app.logger.addHandler(handler)
+    host, port = app.config['GEVENT_BIND'].rsplit(':', 1)
+    server = WSGIServer((host, int(port)), app,
+                        spawn=Pool(app.config['GEVENT_MAX_CONNECTIONS']),
+                        log=None)
+    server.serve_forever()
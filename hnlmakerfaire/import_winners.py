@@ -0,0 +1,29 @@
+import io
+import sys
+from app import app
+from app import import_raffle_winners
+from app import parse_raffle_winners
+from app import RaffleWinnerImportError
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: python import_winners.py <winners.csv|winners.json|->')
+
+    try:
+        if sys.argv[1] == '-':
+            text = sys.stdin.read().decode('utf-8')
+        else:
+            with io.open(sys.argv[1], encoding='utf-8') as f:
+                text = f.read()
+    except UnicodeDecodeError as e:
+        sys.exit('{0} is not UTF-8: {1}'.format(sys.argv[1], e))
+
+    with app.app_context():
+        try:
+            matches = import_raffle_winners(parse_raffle_winners(text))
+        except RaffleWinnerImportError as e:
+            sys.exit('\n'.join(e.errors))
+
+    for match in matches:
+        print '{0}\t{1}'.format(match.raffle_number, match.phone_number)
@@ -3,9 +3,59 @@ import os
 TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID', None)
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN', None)
 TWILIO_NUMBER = os.environ.get('TWILIO_NUMBER', None)
+TWILIO_API_BASE = os.environ.get('TWILIO_API_BASE', 'https://api.twilio.com')
+OUTBOUND_SENDER_THREADS = int(os.environ.get('HNLMAKERFAIRE_OUTBOUND_SENDER_THREADS', 4))
+OUTBOUND_MAX_ATTEMPTS = 5
+OUTBOUND_RETRY_BACKOFF = 2
+OUTBOUND_POLL_INTERVAL = 5
+OUTBOUND_SENDING_TIMEOUT = 300
 HNLMAKERFAIRE_USERNAME = os.environ.get('HNLMAKERFAIRE_USERNAME', None)
 HNLMAKERFAIRE_PASSWORD = os.environ.get('HNLMAKERFAIRE_PASSWORD', None)
 ENVIRONMENT = os.environ.get('HNLMAKERFAIRE_ENVIRONMENT', 'Development')
 DATABASE = os.environ.get('HNLMAKERFAIRE_DATABASE', None)
+DATABASE_URL = os.environ.get('HNLMAKERFAIRE_DATABASE_URL', None)
+DATABASE_ISOLATION_LEVEL = os.environ.get('HNLMAKERFAIRE_DATABASE_ISOLATION_LEVEL', None)
+DATABASE_JOURNAL_MODE = os.environ.get('HNLMAKERFAIRE_DATABASE_JOURNAL_MODE', 'WAL')
+DATABASE_SYNCHRONOUS = os.environ.get('HNLMAKERFAIRE_DATABASE_SYNCHRONOUS', 'NORMAL')
+DATABASE_BUSY_TIMEOUT = int(os.environ.get('HNLMAKERFAIRE_DATABASE_BUSY_TIMEOUT', 5000))
+DATABASE_POOL_SIZE = int(os.environ.get('HNLMAKERFAIRE_DATABASE_POOL_SIZE', 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('HNLMAKERFAIRE_DATABASE_MAX_OVERFLOW', 10))
+SHARED_STATE_URL = os.environ.get('HNLMAKERFAIRE_SHARED_STATE_URL', None)
+SHARED_STATE_PREFIX = os.environ.get('HNLMAKERFAIRE_SHARED_STATE_PREFIX', 'hnlmakerfaire:')
+SHARED_STATE_TTL = 60
+GEVENT_BIND = os.environ.get('HNLMAKERFAIRE_GEVENT_BIND', '127.0.0.1:8000')
+GEVENT_MAX_CONNECTIONS = int(os.environ.get('HNLMAKERFAIRE_GEVENT_MAX_CONNECTIONS', 1000))
+RATE_LIMIT_ENABLED = os.environ.get('HNLMAKERFAIRE_RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('HNLMAKERFAIRE_RATE_LIMIT_PER_MINUTE', 10))
+RATE_LIMIT_BURST = int(os.environ.get('HNLMAKERFAIRE_RATE_LIMIT_BURST', 10))
+RATE_LIMIT_FILE = os.environ.get('HNLMAKERFAIRE_RATE_LIMIT_FILE', '/tmp/hnlmakerfaire/rate_limits')
+RATE_LIMIT_SLOTS = 65536
+STATS_SHARDS = 8
+STATS_DASHBOARD_MINUTES = 60
+STATS_REFRESH_SECONDS = 10
+STATIC_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'build', 'manifest.json')
+STATIC_BUILD_MAX_AGE = 365 * 24 * 60 * 60
+ADMIN_PAGE_SIZE = 100
+EXPORT_CHUNK_SIZE = 1000
+IDEMPOTENCY_TTL = 3600
+IDEMPOTENCY_CACHE_SIZE = 10000
+IDEMPOTENCY_PURGE_EVERY = 1000
+INGEST_WRITE_BEHIND = os.environ.get('HNLMAKERFAIRE_INGEST_WRITE_BEHIND', 'false').lower() == 'true'
+INGEST_LOG_DIR = os.environ.get('HNLMAKERFAIRE_INGEST_LOG_DIR', '/tmp/hnlmakerfaire/ingest')
+INGEST_LOG_FSYNC = True
+INGEST_BATCH_SIZE = 500
+INGEST_FLUSH_INTERVAL = 0.05
+INGEST_RECOVERY_INTERVAL = 30
+INGEST_SAVE_ATTEMPTS = 8
+INGEST_RETRY_MAX_DELAY = 5
+METRICS_DIR = os.environ.get('HNLMAKERFAIRE_METRICS_DIR', '/tmp/hnlmakerfaire/metrics')
+METRICS_FLUSH_INTERVAL = 1
+SLOW_REQUEST_THRESHOLD = 0.5
+AUDIT_WRITE_BEHIND = os.environ.get('HNLMAKERFAIRE_AUDIT_WRITE_BEHIND', 'false').lower() == 'true'
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 1
+LIVE_EVENTS_ENABLED = os.environ.get('HNLMAKERFAIRE_LIVE_EVENTS', 'false').lower() == 'true'
+EVENT_POLL_INTERVAL = 1
+EVENT_KEEPALIVE_INTERVAL = 15
 WTF_CSRF_ENABLED = False
 SECRET_KEY = 'boomshakalaka'